@@ -29,7 +29,8 @@ from aptos_sdk.type_tag import StructTag, TypeTag
 from telethon.sync import TelegramClient
 from telethon import functions, types
 import time
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument
+from pymongo.errors import OperationFailure
 import uuid
 from flask_cors import CORS, cross_origin
 
@@ -57,6 +58,18 @@ datestamp = datetime.datetime.now().strftime("%Y-%m-%d")
 log_folder = direc + "/static/logs"
 os.makedirs(log_folder, exist_ok=True)
 
+# Days community activity entries are kept before MongoDB expires them, 0 keeps them forever
+ACTIVITY_TTL_DAYS = int(os.getenv("ACTIVITY_TTL_DAYS", "0"))
+# Default and max number of activity entries returned per /get_stats_by_community page
+ACTIVITY_PAGE_SIZE = int(os.getenv("ACTIVITY_PAGE_SIZE", "100"))
+ACTIVITY_MAX_PAGE_SIZE = int(os.getenv("ACTIVITY_MAX_PAGE_SIZE", "1000"))
+# Receivers per batch transfer transaction, kept well below the transaction size limit
+BATCH_TRANSFER_CHUNK_SIZE = int(os.getenv("BATCH_TRANSFER_CHUNK_SIZE", "500"))
+# TeleTokens seeded into each new member's wallet
+WALLET_SEED_AMOUNT = int(os.getenv("WALLET_SEED_AMOUNT", "1000"))
+# Key encrypting pooled wallets until they are claimed, shared with the bot that fills the pool
+WALLET_POOL_SECRET = os.getenv("WALLET_POOL_SECRET", "<Add Wallet Pool Secret here>")
+
 name = "<Add Telegram Bot Name here>"
 api_id = "<Add Telegram API ID here>"
 api_hash = "<Add Telegram API Hash here>"
@@ -78,6 +91,167 @@ db_client = get_database()
 community_collection = db_client["telegram_community"]
 topics_collection = db_client["community_topics"]
 users_collection = db_client["community_users"]
+activity_collection = db_client["community_activity"]
+wallet_pool_collection = db_client["wallet_pool"]
+points_ledger_collection = db_client["points_ledger"]
+
+
+def ensure_indexes():
+    """Create the indexes behind every hot query. Safe to run on every start."""
+    index_specs = [
+        (community_collection, [("community_id", 1)], {"unique": True}),
+        (community_collection, [("owner_id", 1)], {}),
+        (users_collection, [("user_id", 1), ("community_id", 1)], {"unique": True}),
+        (topics_collection, [("topic_id", 1), ("community_id", 1)], {}),
+        (activity_collection, [("community_id", 1), ("timestamp", -1), ("_id", -1)], {}),
+        (wallet_pool_collection, [("state", 1), ("created_at", 1)], {}),
+        (points_ledger_collection, [("state", 1), ("timestamp", 1)], {}),
+        (points_ledger_collection, [("user_id", 1), ("community_id", 1), ("state", 1)], {}),
+    ]
+    for collection, keys, options in index_specs:
+        try:
+            collection.create_index(keys, **options)
+        except OperationFailure as e:
+            print(f"Could not create index {keys} on {collection.name}: {e}")
+    if ACTIVITY_TTL_DAYS > 0:
+        ttl_seconds = ACTIVITY_TTL_DAYS * 24 * 60 * 60
+        try:
+            activity_collection.create_index("timestamp", expireAfterSeconds=ttl_seconds)
+        except OperationFailure:
+            # The TTL index exists with another expiry, update it in place
+            db_client.command(
+                "collMod",
+                activity_collection.name,
+                index={"keyPattern": {"timestamp": 1}, "expireAfterSeconds": ttl_seconds},
+            )
+
+
+ensure_indexes()
+
+
+def plan_stages(plan):
+    """Yield every stage name of an explain() query plan tree."""
+    yield plan.get("stage")
+    for child in [plan.get("inputStage"), *plan.get("inputStages", [])]:
+        if child != None:
+            yield from plan_stages(child)
+
+
+def check_query_plans():
+    """Explain every hot query and return the ones that fall back to a collection scan."""
+    hot_queries = [
+        ("community by id", community_collection, {"community_id": "0"}, None),
+        ("communities by owner", community_collection, {"owner_id": "0"}, None),
+        ("user by id and community", users_collection, {"user_id": "0", "community_id": "0"}, None),
+        ("user by id", users_collection, {"user_id": "0"}, None),
+        ("topic by id and community", topics_collection, {"topic_id": 1, "community_id": "0"}, None),
+        ("activity page", activity_collection, {"community_id": "0"}, [("timestamp", -1), ("_id", -1)]),
+        ("pooled wallet", wallet_pool_collection, {"state": "ready"}, [("created_at", 1)]),
+        ("pending points", points_ledger_collection, {"user_id": "0", "community_id": "0", "state": "pending"}, None),
+        ("points to settle", points_ledger_collection, {"state": "pending"}, [("timestamp", 1)]),
+    ]
+    failures = []
+    for name, collection, query, sort in hot_queries:
+        cursor = collection.find(query).limit(1)
+        if sort != None:
+            cursor = cursor.sort(sort)
+        stages = list(plan_stages(cursor.explain()["queryPlanner"]["winningPlan"]))
+        print(f"{name}: {' <- '.join(stage for stage in stages if stage)}")
+        if "COLLSCAN" in stages:
+            failures.append(name)
+    return failures
+
+
+def record_activity(community_id, username, message):
+    """Append an entry to the community's activity history."""
+    activity_collection.insert_one(
+        {
+            "_id": str(uuid.uuid4()),
+            "community_id": str(community_id),
+            "timestamp": datetime.datetime.now(),
+            "username": username,
+            "message": message,
+        }
+    )
+
+
+def get_activity_page(community_id, limit, before=None):
+    """Return up to ``limit`` activity entries older than ``before`` (oldest first) and the cursor of the next page.
+
+    Entries are ordered by ``(timestamp, _id)`` and the cursor is
+    ``"<timestamp>|<_id>"`` of the last entry returned, so entries sharing a
+    timestamp are not skipped between pages. A bare timestamp is still accepted.
+    """
+    query = {"community_id": str(community_id)}
+    if before:
+        timestamp, _, entry_id = before.partition("|")
+        timestamp = datetime.datetime.fromisoformat(timestamp)
+        if entry_id:
+            query["$or"] = [
+                {"timestamp": {"$lt": timestamp}},
+                {"timestamp": timestamp, "_id": {"$lt": entry_id}},
+            ]
+        else:
+            query["timestamp"] = {"$lt": timestamp}
+    entries = list(
+        activity_collection.find(query, {"community_id": 0})
+        .sort([("timestamp", -1), ("_id", -1)])
+        .limit(limit)
+    )
+    next_before = (
+        f"{entries[-1]['timestamp'].isoformat()}|{entries[-1]['_id']}"
+        if len(entries) == limit
+        else None
+    )
+    for entry in entries:
+        del entry["_id"]
+        entry["timestamp"] = str(entry["timestamp"])
+    entries.reverse()
+    return entries, next_before
+
+def get_unsettled_points(user_id, community_id):
+    """Sum of the user's ledger deltas the bot has not settled on chain yet."""
+    totals = list(
+        points_ledger_collection.aggregate(
+            [
+                {
+                    "$match": {
+                        "user_id": str(user_id),
+                        "community_id": str(community_id),
+                        "state": {"$in": ["pending", "submitted"]},
+                    }
+                },
+                {"$group": {"_id": None, "amount": {"$sum": "$amount"}}},
+            ]
+        )
+    )
+    return totals[0]["amount"] if totals else 0
+
+# Community stats counters, stored as integers (older documents may still hold strings)
+STAT_FIELDS = ["number_of_messages", "points_earned", "number_of_nfts_minted"]
+
+
+def normalize_stats(stats):
+    """Return the stats with every counter as an int, whether it was stored as a number or a string."""
+    stats = dict(stats)
+    for field in STAT_FIELDS:
+        try:
+            stats[field] = int(stats.get(field) or 0)
+        except (TypeError, ValueError):
+            stats[field] = 0
+    return stats
+
+
+def stat_to_long(field):
+    """Aggregation expression reading a stats counter as a long, accepting both stored forms."""
+    return {
+        "$convert": {
+            "input": f"$stats.{field}",
+            "to": "long",
+            "onError": 0,
+            "onNull": 0,
+        }
+    }
 
 
 class CoinClient(RestClient):
@@ -148,6 +322,93 @@ class CoinClient(RestClient):
             owner, TransactionPayload(payload)
         )
 
+    async def batch_transfer(
+        self,
+        sender: Account,
+        coin_address: AccountAddress,
+        recipients: list,
+        chunk_size: int = BATCH_TRANSFER_CHUNK_SIZE,
+        on_submit=None,
+    ) -> list:
+        """Transfers the coin to many receivers, ``chunk_size`` of them per transaction.
+
+        ``recipients`` is a list of ``(address, amount)`` pairs. Returns one result
+        per recipient, in order, with the ``txn_hash`` of its chunk and whether
+        that transaction succeeded. ``on_submit`` is awaited with each chunk's
+        results once it is submitted, before it is confirmed.
+        """
+
+        results = [
+            {"address": str(address), "amount": amount, "txn_hash": None, "success": False}
+            for address, amount in recipients
+        ]
+        for start in range(0, len(recipients), chunk_size):
+            chunk = recipients[start : start + chunk_size]
+            chunk_results = results[start : start + chunk_size]
+            payload = EntryFunction.natural(
+                "0x1::aptos_account",
+                "batch_transfer_coins",
+                [
+                    TypeTag(
+                        StructTag.from_str(
+                            f"{coin_address}::telegage_token::TeleGageToken"
+                        )
+                    )
+                ],
+                [
+                    TransactionArgument(
+                        [address for address, _ in chunk],
+                        Serializer.sequence_serializer(Serializer.struct),
+                    ),
+                    TransactionArgument(
+                        [amount for _, amount in chunk],
+                        Serializer.sequence_serializer(Serializer.u64),
+                    ),
+                ],
+            )
+            try:
+                signed_transaction = await self.create_bcs_signed_transaction(
+                    sender, TransactionPayload(payload)
+                )
+                txn_hash = await self.submit_bcs_transaction(signed_transaction)
+            except Exception as e:
+                for result in chunk_results:
+                    result["error"] = str(e)
+                continue
+            for result in chunk_results:
+                result["txn_hash"] = txn_hash
+            if on_submit != None:
+                await on_submit(chunk_results)
+            try:
+                # Chunks share the sender's sequence number, confirm one before the next
+                await self.wait_for_transaction(txn_hash)
+            except Exception as e:
+                for result in chunk_results:
+                    result["error"] = str(e)
+                continue
+            for result in chunk_results:
+                result["success"] = True
+        return results
+
+    async def batch_mint(
+        self,
+        minter: Account,
+        recipients: list,
+        chunk_size: int = BATCH_TRANSFER_CHUNK_SIZE,
+        on_submit=None,
+    ) -> list:
+        """Mints the total of ``recipients`` to the minter in one transaction and distributes it with ``batch_transfer``."""
+
+        if not recipients:
+            return []
+        txn_hash = await self.mint_coin(
+            minter, minter.address(), sum(amount for _, amount in recipients)
+        )
+        await self.wait_for_transaction(txn_hash)
+        return await self.batch_transfer(
+            minter, minter.address(), recipients, chunk_size, on_submit
+        )
+
     async def get_balance(
         self,
         coin_address: AccountAddress,
@@ -199,3 +460,106 @@ def decrypt(key, source, decode=True):
     ):  # Python 2.x: chr(padding) * padding
         raise ValueError("Invalid padding...")
     return data[:-padding]  # remove the padding
+
+
+def claim_pooled_wallet(user_id, community_id):
+    """Take a ready wallet from the bot's pool, returning its address and user-encrypted key, or None if the pool is empty."""
+    entry = wallet_pool_collection.find_one_and_update(
+        {"state": "ready"},
+        {
+            "$set": {
+                "state": "claimed",
+                "claimed_at": datetime.datetime.now(),
+                "claimed_by": {"user_id": str(user_id), "community_id": str(community_id)},
+            }
+        },
+        sort=[("created_at", 1)],
+        return_document=ReturnDocument.AFTER,
+    )
+    if entry == None:
+        return None
+    private_key = decrypt(WALLET_POOL_SECRET.encode(), entry["data"]).decode()
+    return entry["address"], str(encrypt(str(user_id).encode(), private_key.encode()))
+
+
+def consume_pooled_wallet(address):
+    """Delete a claimed wallet once its user row is written, so its key is only stored encrypted for the user."""
+    wallet_pool_collection.delete_one({"address": address, "state": "claimed"})
+
+
+def release_pooled_wallet(address):
+    """Put a claimed wallet back into the pool when its user row was not written; other addresses are left alone."""
+    wallet_pool_collection.update_one(
+        {"address": address, "state": "claimed"},
+        {"$set": {"state": "ready"}, "$unset": {"claimed_at": "", "claimed_by": ""}},
+    )
+
+
+async def provision_user_wallet(user_id, seed_amount=WALLET_SEED_AMOUNT):
+    """Create, fund, register and (unless ``seed_amount`` is 0) seed a new wallet inline, returning its address and user-encrypted key."""
+    user_account = Account.generate()
+    try:
+        await faucet_client.fund_account(user_account.address(), 20_000_000)
+    except:
+        await faucet_client.fund_account(user_account.address(), 20_000_000)
+    txn_hash = await aptos_client.register_coin(admin_wallet.address(), user_account)
+    await aptos_client.wait_for_transaction(txn_hash)
+    if seed_amount > 0:
+        txn_hash = await aptos_client.mint_coin(
+            admin_wallet, user_account.address(), seed_amount
+        )
+        await aptos_client.wait_for_transaction(txn_hash)
+    encrypted = encrypt(str(user_id).encode(), str(user_account.private_key).encode())
+    return str(user_account.account_address), str(encrypted)
+
+
+async def get_user_wallet(user_id, community_id, seed=True):
+    """Claim a pooled wallet for the user, falling back to creating one inline when the pool is empty.
+
+    Returns the address, the user-encrypted key and whether the wallet still
+    needs its seed: pooled wallets come seeded, inline ones are only seeded
+    here when ``seed`` is true so bulk imports can pass them to ``seed_wallets``.
+    """
+    wallet = claim_pooled_wallet(user_id, community_id)
+    if wallet != None:
+        return (*wallet, False)
+    address, encrypted = await provision_user_wallet(
+        user_id, WALLET_SEED_AMOUNT if seed else 0
+    )
+    return address, encrypted, not seed
+
+
+async def seed_wallets(addresses, amount=WALLET_SEED_AMOUNT):
+    """Seed many new wallets with one mint and batched transfers, returning the addresses that were not seeded.
+
+    Wallets the batch missed are minted to one at a time, unless they already
+    hold the seed because their chunk committed after it was given up on.
+    """
+    try:
+        results = await aptos_client.batch_mint(
+            admin_wallet, [(AccountAddress.from_str(address), amount) for address in addresses]
+        )
+        missed = [result["address"] for result in results if not result["success"]]
+    except Exception as e:
+        print(f"Minting the wallet seeds failed: {e}")
+        missed = list(addresses)
+    unseeded = []
+    for address in missed:
+        try:
+            account_address = AccountAddress.from_str(address)
+            if int(await aptos_client.get_balance(admin_wallet.address(), account_address)) >= amount:
+                continue
+            txn_hash = await aptos_client.mint_coin(admin_wallet, account_address, amount)
+            await aptos_client.wait_for_transaction(txn_hash)
+        except Exception as e:
+            print(f"Seeding wallet {address} failed: {e}")
+            unseeded.append(address)
+    return unseeded
+
+
+def mark_unseeded_wallets(addresses):
+    """Leave the seeding of these wallets to the bot, whose wallet provisioning mints the seed of ``registered`` users."""
+    users_collection.update_many(
+        {"TeleTokens_CustodialAddress": {"$in": list(addresses)}},
+        {"$set": {"wallet_state": "registered"}},
+    )
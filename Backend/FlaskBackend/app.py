@@ -10,14 +10,33 @@ from TeleGage import (
     community_collection,
     users_collection,
     Account,
+    AccountAddress,
     admin_wallet,
     encrypt,
     TelegramClient,
     name,
     api_id,
     api_hash,
+    STAT_FIELDS,
+    normalize_stats,
+    stat_to_long,
+    activity_collection,
+    record_activity,
+    get_activity_page,
+    ACTIVITY_PAGE_SIZE,
+    ACTIVITY_MAX_PAGE_SIZE,
+    ensure_indexes,
+    check_query_plans,
+    get_user_wallet,
+    release_pooled_wallet,
+    consume_pooled_wallet,
+    seed_wallets,
+    mark_unseeded_wallets,
+    get_unsettled_points,
 )
+from pymongo.errors import BulkWriteError
 from flask import url_for, render_template, request
+import click
 import json
 import pickle
 import requests, traceback
@@ -76,6 +95,7 @@ async def create_telegram_channel():
                     topic_item = {
                         "_id": str(uuid.uuid4()),
                         "topic_id": topic_id,
+                        "community_id": f"-100{channel.id}",
                         "topic_name": topic.get("Name"),
                         "topic_rules": topic.get("Rules"),
                         "topic_instructions": topic.get("Instructions"),
@@ -92,6 +112,7 @@ async def create_telegram_channel():
                 topic_item = {
                     "_id": str(uuid.uuid4()),
                     "topic_id": topic_id,
+                    "community_id": f"-100{channel.id}",
                     "topic_name": topic_name,
                     "topic_rules": "For Bot User",
                     "topic_instructions": "For Bot Use",
@@ -112,6 +133,7 @@ async def create_telegram_channel():
                 topic_item = {
                     "_id": str(uuid.uuid4()),
                     "topic_id": topic_id,
+                    "community_id": f"-100{channel.id}",
                     "topic_name": topic_name,
                     "topic_rules": "For Bot User",
                     "topic_instructions": "For Bot Use",
@@ -125,55 +147,43 @@ async def create_telegram_channel():
                 )
                 users = telethon_client.iter_participants(channel.id)
                 user_ids = []
+                to_seed = []
                 async for i in users:
                     # print(i)
                     try:
                         print(i)
                         if i.bot == False:
-                            user_account = Account.generate()
-                            try:
-                                await faucet_client.fund_account(
-                                    user_account.address(), 20_000_000
-                                )
-                            except:
-                                await faucet_client.fund_account(
-                                    user_account.address(), 20_000_000
-                                )
-                            updateddata = str(user_account.private_key)
-                            print(user_account.account_address)
-                            encrypted = encrypt(
-                                str(i.id).encode(), updateddata.encode()
+                            address, encrypted, needs_seed = await get_user_wallet(
+                                i.id, f"-100{channel.id}", seed=False
                             )
                             user_item = {
                                 "_id": str(uuid.uuid4()),
                                 "user_id": str(i.id),
                                 "user_name": i.username,
                                 "name": f"{i.first_name if i.first_name!=None else '' } {i.last_name if i.last_name!=None else '' }",
-                                "TeleTokens_CustodialAddress": str(
-                                    user_account.account_address
-                                ),
-                                "data": str(encrypted),
+                                "TeleTokens_CustodialAddress": address,
+                                "data": encrypted,
                                 "community_id": f"-100{channel.id}",
                             }
-                            txn_hash = await aptos_client.register_coin(
-                                admin_wallet.address(), user_account
-                            )
-                            await aptos_client.wait_for_transaction(txn_hash)
-                            txn_hash = await aptos_client.mint_coin(
-                                admin_wallet, user_account.address(), 1000
-                            )
-                            await aptos_client.wait_for_transaction(txn_hash)
-                            user_ids.append(
-                                users_collection.insert_one(user_item).inserted_id
-                            )
-                            balance = await aptos_client.get_balance(
-                                admin_wallet.address(), user_account.address()
-                            )
-                            print(
-                                f"Account for {i.username} : initial TeleGage balance: {balance}"
-                            )
+                            try:
+                                user_ids.append(
+                                    users_collection.insert_one(user_item).inserted_id
+                                )
+                            except:
+                                # Do not leak a pooled wallet to a user that was not added
+                                release_pooled_wallet(address)
+                                raise
+                            consume_pooled_wallet(address)
+                            print(f"Wallet for {i.username}: {address}")
+                            if needs_seed:
+                                to_seed.append(address)
                     except:
                         print(traceback.format_exc())
+                if to_seed:
+                    unseeded = await seed_wallets(to_seed)
+                    if unseeded:
+                        print(f"Wallets left for the bot to seed: {unseeded}")
+                        mark_unseeded_wallets(unseeded)
                 result = await telethon_client(
                     functions.channels.InviteToChannelRequest(
                         channel, ["TeleGageCommunityBot"]
@@ -217,12 +227,11 @@ async def create_telegram_channel():
                 "announcements_id":announcements_id,
                 "users": user_ids,
                 "stats": {
-                    "number_of_messages": "0",
-                    "points_earned": "0",
-                    "number_of_nfts_minted": "0",
+                    "number_of_messages": 0,
+                    "points_earned": 0,
+                    "number_of_nfts_minted": 0,
                     "users_to_be_kicked_out": [],
                     "community_id": f"-100{channel.id}",
-                    "actions": [],
                 },
             }
             
@@ -241,18 +250,53 @@ async def get_stats_by_community():
         print("JSON", request.json)
         print("fomr", request.form)
         telegram_channel_id = request.json.get("telegram_channel_id", "NA")
+        before = request.json.get("before")
         try:
+            limit = min(
+                int(request.json.get("limit", ACTIVITY_PAGE_SIZE)), ACTIVITY_MAX_PAGE_SIZE
+            )
             community = community_collection.find_one(
-                {"community_id": telegram_channel_id}   
+                {"community_id": telegram_channel_id}, {"stats.actions": 0}
             )
-            stats = community.get("stats", {})
-            return {"code": 200, "Stats": stats}
+            stats = normalize_stats(community.get("stats", {}))
+            stats["actions"], next_before = get_activity_page(
+                telegram_channel_id, limit, before
+            )
+            return {"code": 200, "Stats": stats, "next_before": next_before}
         except Exception as e:
             # Rollback changes if an error occurs
             print(traceback.format_exc())
     return {"code": 201}
 
 
+@app.route("/get_user_points", methods=["POST"])
+async def get_user_points():
+    if request.method == "POST":
+        print("JSON", request.json)
+        telegram_channel_id = request.json.get("telegram_channel_id", "NA")
+        user_id = request.json.get("user_id", "NA")
+        try:
+            user = users_collection.find_one(
+                {"user_id": str(user_id), "community_id": str(telegram_channel_id)}
+            )
+            onchain = int(
+                await aptos_client.get_balance(
+                    admin_wallet.address(),
+                    AccountAddress.from_str(user["TeleTokens_CustodialAddress"]),
+                )
+            )
+            unsettled = get_unsettled_points(user_id, telegram_channel_id)
+            return {
+                "code": 200,
+                "Balance": onchain + unsettled,
+                "Settled": onchain,
+                "Unsettled": unsettled,
+            }
+        except Exception as e:
+            print(traceback.format_exc())
+    return {"code": 201}
+
+
 @app.route("/get_topics_by_community", methods=["POST"])
 async def get_topics_by_community():
     if request.method == "POST":
@@ -316,17 +360,10 @@ async def kick_user_from_community():
                     {"community_id": str(telegram_channel_username)},
                     {"$pull": {"stats.users_to_be_kicked_out": {"user_id": str(user_id)}}}
                 )
-                community_collection.update_one(
-                    {"community_id": str(telegram_channel_username)},
-                    {
-                        "$push": {
-                            "stats.actions": {
-                                "timestamp": str(datetime.now()),
-                                "username": str(user.get("user_name")),
-                                "message": f"{user.get('user_name')} has been Kicked out by the community manager",
-                            }
-                        }
-                    },
+                record_activity(
+                    str(telegram_channel_username),
+                    str(user.get("user_name")),
+                    f"{user.get('user_name')} has been Kicked out by the community manager",
                 )
                 result=await telethon_client.edit_permissions(channel, user_id, view_messages=False)
                 print(result)
@@ -369,6 +406,7 @@ async def import_channel():
                         topic_item = {
                             "_id": str(uuid.uuid4()),
                             "topic_id": topic_id,
+                            "community_id": f"-100{channel.id}",
                             "topic_name": topic.get("Name"),
                             "topic_rules": topic.get("Rules"),
                             "topic_instructions": topic.get("Instructions"),
@@ -380,6 +418,7 @@ async def import_channel():
                         topic_item = {
                             "_id": str(uuid.uuid4()),
                             "topic_id": topic.get("ID"),
+                            "community_id": f"-100{channel.id}",
                             "topic_name": topic.get("Name"),
                             "topic_rules": topic.get("Rules"),
                             "topic_instructions": topic.get("Instructions"),
@@ -396,6 +435,7 @@ async def import_channel():
                 topic_item = {
                     "_id": str(uuid.uuid4()),
                     "topic_id": topic_id,
+                    "community_id": f"-100{channel.id}",
                     "topic_name": topic_name,
                     "topic_rules": "For Bot User",
                     "topic_instructions": "For Bot Use",
@@ -415,6 +455,7 @@ async def import_channel():
                 topic_item = {
                     "_id": str(uuid.uuid4()),
                     "topic_id": topic_id,
+                    "community_id": f"-100{channel.id}",
                     "topic_name": topic_name,
                     "topic_rules": "For Bot User",
                     "topic_instructions": "For Bot Use",
@@ -427,55 +468,42 @@ async def import_channel():
                 )
                 users = telethon_client.iter_participants(channel.id)
                 user_ids = []
+                to_seed = []
                 async for i in users:
                     # print(i)
                     try:
                         if i.bot == False:
-                            user_account = Account.generate()
-                            try:
-                                await faucet_client.fund_account(
-                                    user_account.address(), 20_000_000
-                                )
-                            except:
-                                await faucet_client.fund_account(
-                                    user_account.address(), 20_000_000
-                                )
-                            updateddata = str(user_account.private_key)
-                            print(user_account.account_address)
-                            encrypted = encrypt(
-                                str(i.id).encode(), updateddata.encode()
+                            address, encrypted, needs_seed = await get_user_wallet(
+                                i.id, f"-100{channel.id}", seed=False
                             )
-                            print(encrypted)
                             user_item = {
                                 "_id": str(uuid.uuid4()),
                                 "user_id": str(i.id),
                                 "user_name": i.username,
                                 "name": f"{i.first_name if i.first_name!=None else '' } {i.last_name if i.last_name!=None else '' }",
-                                "TeleTokens_CustodialAddress": str(
-                                    user_account.account_address
-                                ),
-                                "data": str(encrypted),
+                                "TeleTokens_CustodialAddress": address,
+                                "data": encrypted,
                                 "community_id": f"-100{channel.id}",
                             }
-                            txn_hash = await aptos_client.register_coin(
-                                admin_wallet.address(), user_account
-                            )
-                            await aptos_client.wait_for_transaction(txn_hash)
-                            txn_hash = await aptos_client.mint_coin(
-                                admin_wallet, user_account.address(), 1000
-                            )
-                            await aptos_client.wait_for_transaction(txn_hash)
-                            user_ids.append(
-                                users_collection.insert_one(user_item).inserted_id
-                            )
-                            balance = await aptos_client.get_balance(
-                                admin_wallet.address(), user_account.address()
-                            )
-                            print(
-                                f"Account for {i.username} : initial TeleGage balance: {balance}"
-                            )
+                            try:
+                                user_ids.append(
+                                    users_collection.insert_one(user_item).inserted_id
+                                )
+                            except:
+                                # Do not leak a pooled wallet to a user that was not added
+                                release_pooled_wallet(address)
+                                raise
+                            consume_pooled_wallet(address)
+                            print(f"Wallet for {i.username}: {address}")
+                            if needs_seed:
+                                to_seed.append(address)
                     except:
                         pass
+                if to_seed:
+                    unseeded = await seed_wallets(to_seed)
+                    if unseeded:
+                        print(f"Wallets left for the bot to seed: {unseeded}")
+                        mark_unseeded_wallets(unseeded)
                 result = await telethon_client(
                     functions.channels.InviteToChannelRequest(
                         channel, ["TeleGageCommunityBot"]
@@ -519,12 +547,11 @@ async def import_channel():
                 "owner_id": telegram_channel_owner,
                 "activities_id": activities_id,
                 "stats": {
-                    "number_of_messages": "0",
-                    "points_earned": "0",
-                    "number_of_nfts_minted": "0",
+                    "number_of_messages": 0,
+                    "points_earned": 0,
+                    "number_of_nfts_minted": 0,
                     "users_to_be_kicked_out": [],
                     "community_id": f"-100{channel.id}",
-                    "actions": [],
                 },
             }
             community_collection.insert_one(test_community)
@@ -535,5 +562,118 @@ async def import_channel():
     return {"code": 201}
 
 
+@app.cli.command("check-indexes")
+def check_indexes():
+    """Create the indexes, explain the hot queries and fail if any of them scans a whole collection."""
+    ensure_indexes()
+    failures = check_query_plans()
+    if failures:
+        raise click.ClickException(f"Queries without an index: {', '.join(failures)}")
+    print("All hot queries use an index")
+
+
+@app.cli.command("migrate-topics")
+def migrate_topics():
+    """Scope topics created before topics carried their community_id to that community."""
+    scoped = 0
+    for community in community_collection.find({}, {"community_id": 1, "topics": 1}):
+        result = topics_collection.update_many(
+            {"_id": {"$in": community.get("topics", [])}, "community_id": {"$exists": False}},
+            {"$set": {"community_id": str(community["community_id"])}},
+        )
+        scoped += result.modified_count
+    print(f"Topic migration done, {scoped} topics scoped to their community")
+
+
+@app.cli.command("migrate-stats")
+@click.option("--batch-size", default=500, show_default=True)
+def migrate_stats(batch_size):
+    """Convert string community stats counters to integers, in batches, while the bot keeps running."""
+    has_string_stats = {
+        "$or": [{f"stats.{field}": {"$type": "string"}} for field in STAT_FIELDS]
+    }
+    converted = 0
+    last_id = None
+    while True:
+        query = has_string_stats
+        if last_id != None:
+            query = {"$and": [has_string_stats, {"_id": {"$gt": last_id}}]}
+        ids = [
+            community["_id"]
+            for community in community_collection.find(query, {"_id": 1})
+            .sort("_id", 1)
+            .limit(batch_size)
+        ]
+        if not ids:
+            break
+        # Each document is rewritten atomically by an update pipeline, so increments
+        # the bot applies concurrently are never lost
+        result = community_collection.update_many(
+            {"_id": {"$in": ids}},
+            [{"$set": {f"stats.{field}": stat_to_long(field) for field in STAT_FIELDS}}],
+        )
+        converted += result.modified_count
+        last_id = ids[-1]
+        print(f"Converted stats of {converted} communities")
+    print(f"Stats migration done, {converted} communities converted")
+
+
+@app.cli.command("migrate-activity")
+def migrate_activity():
+    """Move the stats.actions history of every community into the community_activity collection."""
+    moved = 0
+    for community in community_collection.find(
+        {"stats.actions.0": {"$exists": True}}, {"community_id": 1, "stats.actions": 1}
+    ):
+        community_id = str(community["community_id"])
+        actions = community["stats"]["actions"]
+        entries = []
+        for action in actions:
+            try:
+                timestamp = datetime.fromisoformat(str(action.get("timestamp")))
+            except ValueError:
+                timestamp = datetime.now()
+            entries.append(
+                {
+                    # Deterministic ids make re-running after an interruption harmless
+                    "_id": str(
+                        uuid.uuid5(
+                            uuid.NAMESPACE_OID,
+                            f"{community_id}|{action.get('timestamp')}|{action.get('username')}|{action.get('message')}",
+                        )
+                    ),
+                    "community_id": community_id,
+                    "timestamp": timestamp,
+                    "username": action.get("username"),
+                    "message": action.get("message"),
+                }
+            )
+        try:
+            activity_collection.insert_many(entries, ordered=False)
+        except BulkWriteError as e:
+            if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                raise
+        # Drop only the moved entries, anything appended meanwhile stays for the next run
+        community_collection.update_one(
+            {"_id": community["_id"]},
+            [
+                {
+                    "$set": {
+                        "stats.actions": {
+                            "$slice": [
+                                "$stats.actions",
+                                len(actions),
+                                {"$max": [{"$size": "$stats.actions"}, 1]},
+                            ]
+                        }
+                    }
+                }
+            ],
+        )
+        moved += len(actions)
+        print(f"Moved {len(actions)} actions of community {community_id}")
+    print(f"Activity migration done, {moved} actions moved")
+
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", debug=False)
@@ -1,4 +1,5 @@
 from telebot.async_telebot import AsyncTeleBot
+from telebot.asyncio_helper import ApiTelegramException
 from telebot.types import (
     ReplyKeyboardMarkup,
     InlineKeyboardMarkup,
@@ -11,14 +12,25 @@ from telebot.types import (
     InputFile,
 )
 from telebot import types
+from telebot import asyncio_helper
+import argparse
+import hmac
+import multiprocessing
+import signal
+import zlib
+from queue import Empty
 import json
 import requests
 import os
+import sys
 from PIL import Image
 import random
-from pymongo import MongoClient
+from pymongo import AsyncMongoClient
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure, PyMongoError
 import os
-from datetime import datetime
+from datetime import datetime, timedelta
+from collections import OrderedDict
 
 # from openai import OpenAI
 import asyncio
@@ -29,8 +41,8 @@ import requests
 from aptos_sdk.account import Account
 from aptos_sdk.account_address import AccountAddress
 from aptos_sdk.aptos_cli_wrapper import AptosCLIWrapper
-from aptos_sdk.async_client import FaucetClient, RestClient
-from aptos_sdk.bcs import Serializer
+from aptos_sdk.async_client import ApiError, FaucetClient, RestClient
+from aptos_sdk.bcs import Deserializer, Serializer
 from aptos_sdk.package_publisher import PackagePublisher
 from aptos_sdk.transactions import (
     EntryFunction,
@@ -52,9 +64,15 @@ from aptos_sdk.type_tag import StructTag, TypeTag
 import uuid
 import requests
 import shutil
-from openai import AzureOpenAI
+from openai import AsyncAzureOpenAI
+from aiohttp import web
 
-client = AzureOpenAI(
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+client = AsyncAzureOpenAI(
     api_key="<Add Azure OpenAI API Key here>",
     api_version="2024-02-15-preview",
     azure_endpoint="<Add Azure OpenAI Endpoint here>",
@@ -62,7 +80,358 @@ client = AzureOpenAI(
 deployment_name = "<Add Azure OpenAI Deployment Name here>"
 bot_token = "<Add Telegram Bot Token here>"
 
-bot = AsyncTeleBot(bot_token, parse_mode=None)
+# MongoDB connection pool shared by all handlers
+MONGODB_MAX_POOL_SIZE = int(os.getenv("MONGODB_MAX_POOL_SIZE", "100"))
+MONGODB_MIN_POOL_SIZE = int(os.getenv("MONGODB_MIN_POOL_SIZE", "10"))
+MONGODB_MAX_IDLE_TIME_MS = int(os.getenv("MONGODB_MAX_IDLE_TIME_MS", "300000"))
+MONGODB_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGODB_WAIT_QUEUE_TIMEOUT_MS", "10000"))
+# Upper bound on LLM moderation calls running at once, across all communities
+MODERATION_MAX_CONCURRENCY = int(os.getenv("MODERATION_MAX_CONCURRENCY", "32"))
+# Upper bound on LLM moderation calls running at once for a single community
+MODERATION_MAX_PER_COMMUNITY = int(os.getenv("MODERATION_MAX_PER_COMMUNITY", "4"))
+# How long (milliseconds) messages of one community topic are collected into a single LLM call
+MODERATION_BATCH_WINDOW_MS = int(os.getenv("MODERATION_BATCH_WINDOW_MS", "250"))
+# Max messages moderated by a single LLM call, a full batch is sent without waiting
+MODERATION_BATCH_SIZE = int(os.getenv("MODERATION_BATCH_SIZE", "20"))
+# Messages shorter than this (characters or words) are not sent to the LLM
+PREFILTER_MIN_CHARS = int(os.getenv("PREFILTER_MIN_CHARS", "4"))
+PREFILTER_MIN_WORDS = int(os.getenv("PREFILTER_MIN_WORDS", "1"))
+# How long (seconds) a rendered moderation prompt is reused before it is rebuilt from MongoDB
+PROMPT_CACHE_TTL = int(os.getenv("PROMPT_CACHE_TTL", "300"))
+# Max (community, topic) prompts kept in memory
+PROMPT_CACHE_MAX_ENTRIES = int(os.getenv("PROMPT_CACHE_MAX_ENTRIES", "10000"))
+# How long (seconds) community, topic and user documents are served from memory
+COMMUNITY_CACHE_TTL = int(os.getenv("COMMUNITY_CACHE_TTL", "30"))
+TOPIC_CACHE_TTL = int(os.getenv("TOPIC_CACHE_TTL", "300"))
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", "120"))
+# Max documents kept in memory per collection
+DOCUMENT_CACHE_MAX_ENTRIES = int(os.getenv("DOCUMENT_CACHE_MAX_ENTRIES", "10000"))
+# How often (seconds) buffered community stats increments are written, or after this many increments
+STATS_FLUSH_INTERVAL = int(os.getenv("STATS_FLUSH_INTERVAL", "5"))
+STATS_FLUSH_EVENTS = int(os.getenv("STATS_FLUSH_EVENTS", "500"))
+# Days community activity entries are kept before MongoDB expires them, 0 keeps them forever
+ACTIVITY_TTL_DAYS = int(os.getenv("ACTIVITY_TTL_DAYS", "0"))
+# How long (seconds) decrypted custodial accounts stay in memory, and how many at most
+ACCOUNT_CACHE_TTL = int(os.getenv("ACCOUNT_CACHE_TTL", "60"))
+ACCOUNT_CACHE_MAX_ENTRIES = int(os.getenv("ACCOUNT_CACHE_MAX_ENTRIES", "1000"))
+# Background workers creating wallets for new users, attempts per wallet and TeleTokens seeded
+WALLET_PROVISION_WORKERS = int(os.getenv("WALLET_PROVISION_WORKERS", "4"))
+WALLET_PROVISION_MAX_ATTEMPTS = int(os.getenv("WALLET_PROVISION_MAX_ATTEMPTS", "5"))
+WALLET_SEED_AMOUNT = int(os.getenv("WALLET_SEED_AMOUNT", "1000"))
+# Ready wallets kept in the pool: refilled up to the target once fewer than the low-water mark remain, 0 disables the pool
+WALLET_POOL_LOW_WATER = int(os.getenv("WALLET_POOL_LOW_WATER", "10"))
+WALLET_POOL_TARGET = int(os.getenv("WALLET_POOL_TARGET", "50"))
+# Wallets created at once while refilling, and how often (seconds) the pool level is checked
+WALLET_POOL_REFILL_CONCURRENCY = int(os.getenv("WALLET_POOL_REFILL_CONCURRENCY", "4"))
+WALLET_POOL_CHECK_INTERVAL = int(os.getenv("WALLET_POOL_CHECK_INTERVAL", "30"))
+# Key encrypting pooled wallets until they are claimed, shared with the backend
+WALLET_POOL_SECRET = os.getenv("WALLET_POOL_SECRET", "<Add Wallet Pool Secret here>")
+# How often (seconds) pending points are settled on chain, entries settled per run and concurrent user transfers
+LEDGER_SETTLE_INTERVAL = int(os.getenv("LEDGER_SETTLE_INTERVAL", "30"))
+LEDGER_SETTLE_BATCH = int(os.getenv("LEDGER_SETTLE_BATCH", "5000"))
+LEDGER_SETTLE_CONCURRENCY = int(os.getenv("LEDGER_SETTLE_CONCURRENCY", "8"))
+# Receivers per batch transfer transaction, kept well below the transaction size limit
+BATCH_TRANSFER_CHUNK_SIZE = int(os.getenv("BATCH_TRANSFER_CHUNK_SIZE", "500"))
+# Confirmation polling of submitted transactions: first and slowest interval (ms), give-up time (seconds) and parallel lookups
+TX_POLL_INTERVAL_MS = int(os.getenv("TX_POLL_INTERVAL_MS", "250"))
+TX_POLL_MAX_INTERVAL_MS = int(os.getenv("TX_POLL_MAX_INTERVAL_MS", "2000"))
+TX_CONFIRM_TIMEOUT = int(os.getenv("TX_CONFIRM_TIMEOUT", "60"))
+TX_POLL_CONCURRENCY = int(os.getenv("TX_POLL_CONCURRENCY", "16"))
+# How long (seconds) TeleGage balances read from the node are reused, and how many accounts are kept
+BALANCE_CACHE_TTL = int(os.getenv("BALANCE_CACHE_TTL", "30"))
+BALANCE_CACHE_MAX_ENTRIES = int(os.getenv("BALANCE_CACHE_MAX_ENTRIES", "10000"))
+# Admin wallet transactions submitted ahead of confirmation, capped by the mempool's 100 per account
+ADMIN_MAX_IN_FLIGHT = int(os.getenv("ADMIN_MAX_IN_FLIGHT", "100"))
+# Seconds activity lines wait to be posted as one digest to a community's Activities topic, or lines that trigger it early, 0 posts each line
+ACTIVITY_DIGEST_INTERVAL = int(os.getenv("ACTIVITY_DIGEST_INTERVAL", "10"))
+ACTIVITY_DIGEST_MAX_LINES = int(os.getenv("ACTIVITY_DIGEST_MAX_LINES", "20"))
+# Telegram send limits: messages per second overall and per private chat, messages per minute per group
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_GROUP_RATE_PER_MINUTE = float(os.getenv("TELEGRAM_GROUP_RATE_PER_MINUTE", "20"))
+# Times a send is retried after Telegram answers 429 with retry_after
+TELEGRAM_MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", "5"))
+# Webhook mode (--webhook): public URL Telegram posts to, local address to listen on and the secret Telegram sends back
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "<Add Public Webhook URL here>")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "<Add Webhook Secret Token here>")
+# Parallel connections Telegram opens to the webhook (1-100) and seconds in-flight updates get to finish on shutdown
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+WEBHOOK_DRAIN_TIMEOUT = int(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "30"))
+# Updates run in lanes per chat (per chat and user with UPDATE_LANE_PER_USER=1): at most this many lanes, closed after this many idle seconds
+UPDATE_LANES_MAX = int(os.getenv("UPDATE_LANES_MAX", "1000"))
+UPDATE_LANE_IDLE_TIMEOUT = int(os.getenv("UPDATE_LANE_IDLE_TIMEOUT", "60"))
+UPDATE_LANE_PER_USER = os.getenv("UPDATE_LANE_PER_USER", "0") == "1"
+# Seconds queued updates get to finish on shutdown
+UPDATE_DRAIN_TIMEOUT = int(os.getenv("UPDATE_DRAIN_TIMEOUT", "30"))
+# Supervisor mode (--shards): seconds between shard health checks, dead shards are restarted
+SHARD_HEALTH_INTERVAL = int(os.getenv("SHARD_HEALTH_INTERVAL", "5"))
+# Seconds between re-queuing unfinished wallets, including ones the backend left unseeded
+WALLET_RESUME_INTERVAL = int(os.getenv("WALLET_RESUME_INTERVAL", "300"))
+# How often (seconds) the bot prints its internal stats, 0 disables the report
+STATS_REPORT_INTERVAL = int(os.getenv("STATS_REPORT_INTERVAL", "60"))
+
+
+
+class TokenBucket:
+    """Allows ``rate`` calls per second on average with bursts of up to ``capacity``."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def delay(self):
+        """Seconds until a token is available, 0 when one is."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    async def take(self):
+        while True:
+            delay = self.delay()
+            if delay == 0:
+                self.tokens -= 1
+                return
+            await asyncio.sleep(delay)
+
+
+class OutboundQueue:
+    """Sends Telegram requests through one queue per chat under global and per-chat token buckets.
+
+    Each chat has its own worker, so a chat that is rate limited or retrying
+    after a 429 ``retry_after`` never delays the others. ``call`` returns the
+    Telegram result once the request went through. Workers of idle chats exit
+    after ``idle_timeout`` seconds.
+    """
+
+    def __init__(self, global_rate, chat_rate, group_rate_per_minute, max_retries, idle_timeout=60):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate_per_minute / 60
+        self.max_retries = max_retries
+        self.idle_timeout = idle_timeout
+        self.chats = {}
+        self.sent = 0
+        self.rate_limited = 0
+        self.failed = 0
+
+    def _bucket(self, chat_id):
+        # Group and channel ids are negative, channels may also be addressed by @username
+        if not str(chat_id).lstrip("-").isdigit() or int(chat_id) < 0:
+            return TokenBucket(self.group_rate, 3)
+        return TokenBucket(self.chat_rate, 1)
+
+    async def call(self, chat_id, method, *args, **kwargs):
+        chat = self.chats.get(str(chat_id))
+        if chat == None or chat[1].done():
+            queue = asyncio.Queue()
+            worker = asyncio.create_task(self._run(str(chat_id), queue, self._bucket(chat_id)))
+            chat = self.chats[str(chat_id)] = (queue, worker)
+        future = asyncio.get_running_loop().create_future()
+        chat[0].put_nowait((method, args, kwargs, future))
+        return await future
+
+    async def _send(self, bucket, method, args, kwargs):
+        for attempt in range(self.max_retries + 1):
+            await bucket.take()
+            await self.global_bucket.take()
+            try:
+                return await method(*args, **kwargs)
+            except ApiTelegramException as e:
+                if e.error_code != 429 or attempt == self.max_retries:
+                    raise
+                self.rate_limited += 1
+                retry_after = e.result_json.get("parameters", {}).get("retry_after", 1)
+                await asyncio.sleep(retry_after)
+
+    async def _run(self, chat_id, queue, bucket):
+        while True:
+            try:
+                method, args, kwargs, future = await asyncio.wait_for(
+                    queue.get(), self.idle_timeout
+                )
+            except asyncio.TimeoutError:
+                if queue.empty():
+                    self.chats.pop(chat_id, None)
+                    return
+                continue
+            if future.cancelled():
+                continue
+            try:
+                result = await self._send(bucket, method, args, kwargs)
+            except Exception as e:
+                self.failed += 1
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                self.sent += 1
+                if not future.done():
+                    future.set_result(result)
+
+    def stats(self):
+        return {
+            "chats": len(self.chats),
+            "queued": sum(chat[0].qsize() for chat in self.chats.values()),
+            "sent": self.sent,
+            "rate_limited": self.rate_limited,
+            "failed": self.failed,
+        }
+
+
+class UpdateDispatcher:
+    """Runs updates in lanes keyed by chat id, or chat and user id when ``per_user`` is set.
+
+    A lane handles its updates strictly one after another, so one user's
+    messages and token updates apply in the order they arrived, while
+    different lanes run concurrently. At most ``max_lanes`` lanes exist; an
+    update for a new lane waits for a free one. Lanes with nothing to do for
+    ``idle_timeout`` seconds are closed.
+    """
+
+    EVENTS = [
+        "message",
+        "edited_message",
+        "channel_post",
+        "edited_channel_post",
+        "my_chat_member",
+        "chat_member",
+        "chat_join_request",
+        "message_reaction",
+    ]
+
+    def __init__(self, process, max_lanes, idle_timeout, per_user):
+        self.process = process
+        self.idle_timeout = idle_timeout
+        self.per_user = per_user
+        self.slots = asyncio.Semaphore(max_lanes)
+        self.lanes = {}
+        self.processed = 0
+        self.errors = 0
+        self.closed = 0
+
+    def lane_key(self, update):
+        chat, user = None, None
+        for name in self.EVENTS:
+            event = getattr(update, name, None)
+            if event != None:
+                chat, user = event.chat, getattr(event, "from_user", None)
+                break
+        else:
+            callback = getattr(update, "callback_query", None)
+            if callback != None:
+                chat = callback.message.chat if callback.message != None else None
+                user = callback.from_user
+        if chat == None:
+            # Inline queries and the like only have a user
+            return ("user", user.id) if user != None else ("update", update.update_id)
+        if self.per_user and user != None:
+            return (chat.id, user.id)
+        return (chat.id,)
+
+    async def dispatch(self, updates):
+        for update in updates:
+            key = self.lane_key(update)
+            lane = self.lanes.get(key)
+            if lane == None:
+                await self.slots.acquire()
+                # Another dispatch may have opened the lane while we waited
+                lane = self.lanes.get(key)
+                if lane == None:
+                    queue = asyncio.Queue()
+                    lane = self.lanes[key] = (queue, asyncio.create_task(self._run(key, queue)))
+                else:
+                    self.slots.release()
+            lane[0].put_nowait(update)
+
+    async def _run(self, key, queue):
+        try:
+            while True:
+                try:
+                    update = await asyncio.wait_for(queue.get(), self.idle_timeout)
+                except asyncio.TimeoutError:
+                    if queue.empty():
+                        self.closed += 1
+                        return
+                    continue
+                try:
+                    await self.process([update])
+                    self.processed += 1
+                except Exception as e:
+                    self.errors += 1
+                    print(f"Handling update {update.update_id} failed: {e}")
+                finally:
+                    queue.task_done()
+        finally:
+            self.lanes.pop(key, None)
+            self.slots.release()
+
+    async def drain(self, timeout):
+        """Wait up to ``timeout`` seconds for every queued update to be handled."""
+        waiters = [asyncio.create_task(queue.join()) for queue, _ in self.lanes.values()]
+        if waiters:
+            done, pending = await asyncio.wait(waiters, timeout=timeout)
+            for waiter in pending:
+                waiter.cancel()
+
+    def stats(self):
+        return {
+            "lanes": len(self.lanes),
+            "queued": sum(queue.qsize() for queue, _ in self.lanes.values()),
+            "processed": self.processed,
+            "errors": self.errors,
+            "closed_lanes": self.closed,
+        }
+
+
+class RateLimitedTeleBot(AsyncTeleBot):
+    """AsyncTeleBot whose outgoing messages, photos and sticker set changes go through an ``OutboundQueue``.
+
+    ``reply_to`` sends through ``send_message`` and is queued with it. Incoming
+    updates are handled through an ``UpdateDispatcher``.
+    """
+
+    def __init__(self, *args, outbox, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.outbox = outbox
+        self.dispatcher = UpdateDispatcher(
+            super().process_new_updates,
+            UPDATE_LANES_MAX,
+            UPDATE_LANE_IDLE_TIMEOUT,
+            UPDATE_LANE_PER_USER,
+        )
+
+    async def process_new_updates(self, updates):
+        await self.dispatcher.dispatch(updates)
+
+    async def send_message(self, chat_id, *args, **kwargs):
+        return await self.outbox.call(chat_id, super().send_message, chat_id, *args, **kwargs)
+
+    async def send_photo(self, chat_id, *args, **kwargs):
+        return await self.outbox.call(chat_id, super().send_photo, chat_id, *args, **kwargs)
+
+    async def create_new_sticker_set(self, user_id, *args, **kwargs):
+        return await self.outbox.call(
+            user_id, super().create_new_sticker_set, user_id, *args, **kwargs
+        )
+
+    async def add_sticker_to_set(self, user_id, *args, **kwargs):
+        return await self.outbox.call(
+            user_id, super().add_sticker_to_set, user_id, *args, **kwargs
+        )
+
+
+outbox = OutboundQueue(
+    TELEGRAM_GLOBAL_RATE,
+    TELEGRAM_CHAT_RATE,
+    TELEGRAM_GROUP_RATE_PER_MINUTE,
+    TELEGRAM_MAX_RETRIES,
+)
+bot = RateLimitedTeleBot(bot_token, parse_mode=None, outbox=outbox)
 
 APTOS_CORE_PATH = os.getenv(
     "APTOS_CORE_PATH",
@@ -78,10 +447,480 @@ INDEXER_URL = os.getenv(
 )
 NODE_URL = os.getenv("APTOS_NODE_URL", "https://api.testnet.aptoslabs.com/v1")
 
-from telebot.apihelper import get_chat_member
+
+class TransactionFailed(Exception):
+    """A tracked transaction failed on chain or was not confirmed in time."""
+
+    def __init__(self, outcome):
+        super().__init__(f"Transaction {outcome['txn_hash']} {outcome['status']}: {outcome.get('vm_status')}")
+        self.outcome = outcome
+
+
+class ConfirmationTracker:
+    """Confirms submitted transactions from one shared polling loop.
+
+    ``track`` returns a future resolved with ``{"txn_hash", "status",
+    "vm_status"}`` where status is ``success``, ``failure`` or ``timeout``, and
+    can also call ``callback`` with that outcome (a returned coroutine is
+    scheduled), so callers that do not need to wait can move on. Every pending
+    hash is polled in the same round; the interval backs off from
+    ``poll_interval`` to ``max_interval`` while nothing confirms.
+    """
+
+    def __init__(self, client, poll_interval, max_interval, timeout, concurrency):
+        self.client = client
+        self.poll_interval = poll_interval
+        self.max_interval = max_interval
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.pending = {}
+        self.task = None
+        self.wake = None
+        self.rounds = 0
+        self.confirmed = 0
+        self.failed = 0
+        self.timed_out = 0
+
+    def track(self, txn_hash, callback=None):
+        entry = self.pending.get(txn_hash)
+        if entry == None:
+            future = asyncio.get_running_loop().create_future()
+            entry = self.pending[txn_hash] = (future, time.monotonic() + self.timeout)
+        future = entry[0]
+        if callback != None:
+
+            def notify(done):
+                result = callback(done.result())
+                if asyncio.iscoroutine(result):
+                    asyncio.ensure_future(result)
+
+            future.add_done_callback(notify)
+        if self.task == None or self.task.done():
+            self.wake = asyncio.Event()
+            self.task = asyncio.create_task(self._run())
+        else:
+            # New work polls right away at the fastest cadence
+            self.wake.set()
+        return future
+
+    async def wait(self, txn_hash):
+        """Wait for the transaction and raise ``TransactionFailed`` unless it succeeded."""
+        outcome = await asyncio.shield(self.track(txn_hash))
+        if outcome["status"] != "success":
+            raise TransactionFailed(outcome)
+        return outcome
+
+    def _resolve(self, txn_hash, status, vm_status=None):
+        future = self.pending.pop(txn_hash)[0]
+        if not future.done():
+            future.set_result({"txn_hash": txn_hash, "status": status, "vm_status": vm_status})
+
+    async def _poll(self, txn_hash, semaphore):
+        async with semaphore:
+            try:
+                txn = await self.client.transaction_by_hash(txn_hash)
+            except ApiError:
+                # Not visible on this node yet
+                txn = None
+        if txn_hash not in self.pending:
+            return False
+        if txn != None and txn.get("type") != "pending_transaction":
+            if txn.get("success"):
+                self.confirmed += 1
+                self._resolve(txn_hash, "success", txn.get("vm_status"))
+            else:
+                self.failed += 1
+                self._resolve(txn_hash, "failure", txn.get("vm_status"))
+            return True
+        if time.monotonic() > self.pending[txn_hash][1]:
+            self.timed_out += 1
+            self._resolve(txn_hash, "timeout")
+            return True
+        return False
+
+    async def _run(self):
+        interval = self.poll_interval
+        while self.pending:
+            self.wake.clear()
+            try:
+                await asyncio.wait_for(self.wake.wait(), interval)
+                interval = self.poll_interval
+            except asyncio.TimeoutError:
+                pass
+            self.rounds += 1
+            semaphore = asyncio.Semaphore(self.concurrency)
+            resolved = await asyncio.gather(
+                *[self._poll(txn_hash, semaphore) for txn_hash in list(self.pending)],
+                return_exceptions=True,
+            )
+            if any(result is True for result in resolved):
+                interval = self.poll_interval
+            else:
+                interval = min(interval * 2, self.max_interval)
+
+    def stats(self):
+        return {
+            "pending": len(self.pending),
+            "rounds": self.rounds,
+            "confirmed": self.confirmed,
+            "failed": self.failed,
+            "timed_out": self.timed_out,
+        }
+
+
+# Node errors after which the local sequence number of a signer cannot be trusted
+SEQUENCE_NUMBER_ERRORS = ["SEQUENCE_NUMBER_TOO_OLD", "SEQUENCE_NUMBER_TOO_NEW"]
+
+
+class SequenceNumbers:
+    """Hands out one signer's sequence numbers locally so many of its transactions can be in flight.
+
+    The first number comes from the node and later ones are counted here, with
+    at most ``max_in_flight`` transactions submitted but not yet confirmed (the
+    mempool keeps 100 per account). Committed transactions use up their number
+    whether they succeeded or aborted. A number that never reached the mempool
+    is handed back if it was the last one given out, otherwise the client fills
+    it with a no-op so the numbers after it are not parked behind a gap. On
+    sequence number errors the counter is moved up to the node's, never below
+    the numbers still pending.
+    """
+
+    def __init__(self, client, signer, max_in_flight):
+        self.client = client
+        self.signer = signer
+        self.address = signer.address()
+        self.max_in_flight = max_in_flight
+        self.next = None
+        self.in_flight = 0
+        self.condition = asyncio.Condition()
+        self.allocated = 0
+        self.resyncs = 0
+        self.fills = 0
+
+    async def acquire(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < self.max_in_flight)
+            if self.next == None:
+                self.next = await self.client.account_sequence_number(self.address)
+            number = self.next
+            self.next += 1
+            self.in_flight += 1
+            self.allocated += 1
+            return number
+
+    async def give_back(self, number):
+        """Take back ``number``, unused, if no later one was given out. Otherwise it has to be filled."""
+        async with self.condition:
+            if self.next != number + 1:
+                return False
+            self.next = number
+            self.in_flight -= 1
+            self.condition.notify_all()
+            return True
+
+    async def release(self, number, resync=False):
+        """Return ``number`` once it is used up on chain, with ``resync`` after a sequence number error."""
+        async with self.condition:
+            self.in_flight -= 1
+            if resync:
+                try:
+                    onchain = await self.client.account_sequence_number(self.address)
+                    self.next = max(self.next, onchain)
+                    self.resyncs += 1
+                except Exception as e:
+                    print(f"Reading the sequence number of {self.address} failed: {e}")
+            self.condition.notify_all()
+
+    def stats(self):
+        return {
+            "next": self.next,
+            "in_flight": self.in_flight,
+            "allocated": self.allocated,
+            "resyncs": self.resyncs,
+            "fills": self.fills,
+        }
+
+
+class BalanceCache:
+    """TeleGage balances by account address, adjusted optimistically for our own transactions.
+
+    An entry is the balance last read from the node plus the deltas of the
+    mints and transfers we submitted that are not confirmed yet. A confirmed
+    delta is folded into the read balance, a failed or timed out one is
+    dropped. Entries without pending deltas are read again after ``ttl``.
+    """
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # address -> [balance read from the node or None, expiry, {txn_hash: delta}]
+        self.entries = OrderedDict()
+        self.transactions = {}
+        self.hits = 0
+        self.misses = 0
+        self.reverted = 0
+
+    def get(self, address):
+        entry = self.entries.get(address)
+        if entry == None or entry[0] == None or (
+            not entry[2] and entry[1] <= time.monotonic()
+        ):
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(address)
+        return entry[0] + sum(entry[2].values())
+
+    def set(self, address, balance):
+        entry = self.entries.get(address)
+        if entry == None:
+            entry = self.entries[address] = [None, 0, {}]
+        # A read taken while our transactions are pending may already include some of them
+        if entry[0] == None or not entry[2]:
+            entry[0] = balance
+            entry[1] = time.monotonic() + self.ttl
+        self.entries.move_to_end(address)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def adjust(self, txn_hash, deltas):
+        """Apply the balance changes ``[(address, delta)]`` a submitted transaction will make."""
+        for address, delta in deltas:
+            entry = self.entries.get(address)
+            if entry == None:
+                entry = self.entries[address] = [None, 0, {}]
+            entry[2][txn_hash] = entry[2].get(txn_hash, 0) + delta
+            self.transactions.setdefault(txn_hash, set()).add(address)
+
+    def reconcile(self, outcome):
+        for address in self.transactions.pop(outcome["txn_hash"], ()):
+            entry = self.entries.get(address)
+            if entry == None:
+                continue
+            delta = entry[2].pop(outcome["txn_hash"], 0)
+            if outcome["status"] == "success":
+                if entry[0] != None:
+                    entry[0] += delta
+            else:
+                self.reverted += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "pending_transactions": len(self.transactions),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0,
+            "reverted": self.reverted,
+        }
+
+
+class DelegatedTransaction:
+    """Stands in for a signed transaction of a signer whose transactions another process signs."""
+
+    def __init__(self, sender, payload):
+        self.sender = sender
+        self.payload = payload
+
+
+class SigningError(Exception):
+    """The process signing for a delegated signer could not sign or submit its transaction."""
+
+
+class RemoteSigner:
+    """Has the supervisor sign and submit the admin wallet's transactions for a shard.
+
+    Shards would otherwise hand out the same admin sequence numbers. Payloads go
+    out BCS encoded on ``requests`` with the shard's index and a request id, and
+    the transaction hash or the error comes back on ``replies``.
+    """
+
+    def __init__(self, index, requests, replies):
+        self.index = index
+        self.requests = requests
+        self.replies = replies
+        self.futures = {}
+        self.submitted = 0
+        self.errors = 0
+
+    async def submit(self, payload):
+        serializer = Serializer()
+        payload.serialize(serializer)
+        request_id = str(uuid.uuid4())
+        future = asyncio.get_running_loop().create_future()
+        self.futures[request_id] = future
+        self.requests.put((self.index, request_id, serializer.output()))
+        try:
+            return await future
+        finally:
+            self.futures.pop(request_id, None)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                request_id, txn_hash, error = await loop.run_in_executor(
+                    None, self.replies.get, True, 1
+                )
+            except Empty:
+                continue
+            future = self.futures.get(request_id)
+            if future == None or future.done():
+                continue
+            if error != None:
+                self.errors += 1
+                future.set_exception(SigningError(error))
+            else:
+                self.submitted += 1
+                future.set_result(txn_hash)
+
+    def stats(self):
+        return {"waiting": len(self.futures), "submitted": self.submitted, "errors": self.errors}
 
 
 class CoinClient(RestClient):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sequence_numbers = {}
+        self.delegates = {}
+        self.balances = BalanceCache(BALANCE_CACHE_TTL, BALANCE_CACHE_MAX_ENTRIES)
+        self.confirmations = ConfirmationTracker(
+            self,
+            TX_POLL_INTERVAL_MS / 1000,
+            TX_POLL_MAX_INTERVAL_MS / 1000,
+            TX_CONFIRM_TIMEOUT,
+            TX_POLL_CONCURRENCY,
+        )
+
+    def manage_sequence_numbers(self, signer: Account, max_in_flight: int):
+        """Allocate the signer's sequence numbers locally from now on, see ``SequenceNumbers``."""
+        self.sequence_numbers[str(signer.address())] = SequenceNumbers(
+            self, signer, max_in_flight
+        )
+
+    def delegate_signer(self, signer: Account, delegate):
+        """Have ``delegate`` (e.g. a ``RemoteSigner``) sign and submit the signer's transactions from now on."""
+        self.delegates[str(signer.address())] = delegate
+
+    async def create_bcs_signed_transaction(
+        self, sender: Account, payload: TransactionPayload, sequence_number=None
+    ):
+        if str(sender.address()) in self.delegates:
+            return DelegatedTransaction(sender.address(), payload)
+        numbers = self.sequence_numbers.get(str(sender.address()))
+        if numbers == None or sequence_number != None:
+            return await super().create_bcs_signed_transaction(
+                sender, payload, sequence_number=sequence_number
+            )
+        sequence_number = await numbers.acquire()
+        try:
+            return await super().create_bcs_signed_transaction(
+                sender, payload, sequence_number=sequence_number
+            )
+        except Exception:
+            await self._lose_sequence_number(numbers, sequence_number)
+            raise
+
+    async def submit_bcs_transaction(self, signed_transaction) -> str:
+        if isinstance(signed_transaction, DelegatedTransaction):
+            delegate = self.delegates[str(signed_transaction.sender)]
+            return await delegate.submit(signed_transaction.payload)
+        numbers = self.sequence_numbers.get(str(signed_transaction.transaction.sender))
+        if numbers == None:
+            return await super().submit_bcs_transaction(signed_transaction)
+        number = signed_transaction.transaction.sequence_number
+        try:
+            txn_hash = await super().submit_bcs_transaction(signed_transaction)
+        except Exception as e:
+            if any(error in str(e) for error in SEQUENCE_NUMBER_ERRORS):
+                # The number is taken on chain already, or the counter is off
+                await numbers.release(number, resync=True)
+            else:
+                await self._lose_sequence_number(numbers, number)
+            raise
+        self._track_sequence_number(numbers, number, txn_hash)
+        return txn_hash
+
+    def _track_sequence_number(self, numbers, number, txn_hash):
+        def confirmed(outcome):
+            if outcome["status"] != "timeout":
+                # Aborted transactions use up their number too
+                return numbers.release(number)
+            # It may still sit in the mempool until it expires, fill the number after that unless it got used
+            asyncio.get_running_loop().call_later(
+                self.client_config.expiration_ttl,
+                lambda: asyncio.ensure_future(self._fill_sequence_number(numbers, number)),
+            )
+
+        self.confirmations.track(txn_hash, confirmed)
+
+    async def _lose_sequence_number(self, numbers, number):
+        """Deal with a number whose transaction never reached the mempool."""
+        if not await numbers.give_back(number):
+            asyncio.ensure_future(self._fill_sequence_number(numbers, number))
+
+    async def _fill_sequence_number(self, numbers, number):
+        """Use up ``number`` with a 0 coin transfer to the signer itself, retrying until the node takes it."""
+        payload = EntryFunction.natural(
+            "0x1::aptos_account",
+            "transfer",
+            [],
+            [
+                TransactionArgument(numbers.address, Serializer.struct),
+                TransactionArgument(0, Serializer.u64),
+            ],
+        )
+        attempt = 0
+        while True:
+            try:
+                signed_transaction = await super().create_bcs_signed_transaction(
+                    numbers.signer, TransactionPayload(payload), sequence_number=number
+                )
+                txn_hash = await super().submit_bcs_transaction(signed_transaction)
+                break
+            except Exception as e:
+                if "SEQUENCE_NUMBER_TOO_OLD" in str(e):
+                    # Used after all, by the transaction we gave up on or another signer
+                    await numbers.release(number, resync=True)
+                    return
+                attempt += 1
+                print(f"Filling sequence number {number} of {numbers.address} failed, retrying: {e}")
+                await asyncio.sleep(min(2**attempt, 60))
+        numbers.fills += 1
+        self._track_sequence_number(numbers, number, txn_hash)
+
+    async def wait_for_transaction(self, txn_hash: str) -> None:
+        """Wait for the transaction through the shared ``ConfirmationTracker``."""
+        await self.confirmations.wait(txn_hash)
+
+    def _track_balances(self, txn_hash, deltas):
+        self.balances.adjust(txn_hash, [(str(address), delta) for address, delta in deltas])
+        self.confirmations.track(txn_hash, self.balances.reconcile)
+
+    async def transfer_coins(
+        self,
+        sender: Account,
+        recipient: AccountAddress,
+        coin_type: str,
+        amount: int,
+        sequence_number=None,
+        optimistic: bool = True,
+    ) -> str:
+        """Transfers the coin, adjusting the cached balances before confirmation unless ``optimistic`` is unset."""
+        txn_hash = await super().transfer_coins(
+            sender, recipient, coin_type, amount, sequence_number=sequence_number
+        )
+        if optimistic and coin_type.endswith("::telegage_token::TeleGageToken"):
+            self._track_balances(txn_hash, [(sender.address(), -amount), (recipient, amount)])
+        return txn_hash
+
+    def sequence_stats(self):
+        return {
+            **{address: numbers.stats() for address, numbers in self.sequence_numbers.items()},
+            **{address: {"delegated": delegate.stats()} for address, delegate in self.delegates.items()},
+        }
+
     async def register_coin(self, coin_address: AccountAddress, sender: Account) -> str:
         """Register the receiver account to receive transfers for the new coin."""
 
@@ -101,7 +940,11 @@ class CoinClient(RestClient):
         return await self.submit_bcs_transaction(signed_transaction)
 
     async def mint_coin(
-        self, minter: Account, receiver_address: AccountAddress, amount: int
+        self,
+        minter: Account,
+        receiver_address: AccountAddress,
+        amount: int,
+        optimistic: bool = True,
     ) -> str:
         """Mints the newly created coin to a specified receiver address."""
 
@@ -123,25 +966,143 @@ class CoinClient(RestClient):
         signed_transaction = await self.create_bcs_signed_transaction(
             minter, TransactionPayload(payload)
         )
-        return await self.submit_bcs_transaction(signed_transaction)
+        txn_hash = await self.submit_bcs_transaction(signed_transaction)
+        if optimistic:
+            self._track_balances(txn_hash, [(receiver_address, amount)])
+        return txn_hash
+
+    async def batch_transfer(
+        self,
+        sender: Account,
+        coin_address: AccountAddress,
+        recipients: list,
+        chunk_size: int = BATCH_TRANSFER_CHUNK_SIZE,
+        on_submit=None,
+        optimistic: bool = True,
+    ) -> list:
+        """Transfers the coin to many receivers, ``chunk_size`` of them per transaction.
+
+        ``recipients`` is a list of ``(address, amount)`` pairs. Returns one result
+        per recipient, in order, with the ``txn_hash`` of its chunk and whether
+        that transaction succeeded. ``on_submit`` is awaited with each chunk's
+        results once it is submitted, before it is confirmed. The cached
+        balances are adjusted before confirmation unless ``optimistic`` is unset.
+        """
+
+        results = [
+            {"address": str(address), "amount": amount, "txn_hash": None, "success": False}
+            for address, amount in recipients
+        ]
+        pipelined = (
+            str(sender.address()) in self.sequence_numbers
+            or str(sender.address()) in self.delegates
+        )
+        confirmations = []
+
+        async def confirm(txn_hash, chunk_results):
+            try:
+                await self.wait_for_transaction(txn_hash)
+            except Exception as e:
+                for result in chunk_results:
+                    result["error"] = str(e)
+                return
+            for result in chunk_results:
+                result["success"] = True
+
+        for start in range(0, len(recipients), chunk_size):
+            chunk = recipients[start : start + chunk_size]
+            chunk_results = results[start : start + chunk_size]
+            payload = EntryFunction.natural(
+                "0x1::aptos_account",
+                "batch_transfer_coins",
+                [
+                    TypeTag(
+                        StructTag.from_str(
+                            f"{coin_address}::telegage_token::TeleGageToken"
+                        )
+                    )
+                ],
+                [
+                    TransactionArgument(
+                        [address for address, _ in chunk],
+                        Serializer.sequence_serializer(Serializer.struct),
+                    ),
+                    TransactionArgument(
+                        [amount for _, amount in chunk],
+                        Serializer.sequence_serializer(Serializer.u64),
+                    ),
+                ],
+            )
+            try:
+                signed_transaction = await self.create_bcs_signed_transaction(
+                    sender, TransactionPayload(payload)
+                )
+                txn_hash = await self.submit_bcs_transaction(signed_transaction)
+            except Exception as e:
+                for result in chunk_results:
+                    result["error"] = str(e)
+                continue
+            for result in chunk_results:
+                result["txn_hash"] = txn_hash
+            if optimistic:
+                self._track_balances(
+                    txn_hash,
+                    [(sender.address(), -sum(amount for _, amount in chunk)), *chunk],
+                )
+            if on_submit != None:
+                await on_submit(chunk_results)
+            if pipelined:
+                confirmations.append(confirm(txn_hash, chunk_results))
+            else:
+                # Without local sequence numbers, confirm one chunk before the next
+                await confirm(txn_hash, chunk_results)
+        await asyncio.gather(*confirmations)
+        return results
+
+    async def batch_mint(
+        self,
+        minter: Account,
+        recipients: list,
+        chunk_size: int = BATCH_TRANSFER_CHUNK_SIZE,
+        on_submit=None,
+        optimistic: bool = True,
+    ) -> list:
+        """Mints the total of ``recipients`` to the minter in one transaction and distributes it with ``batch_transfer``."""
+
+        if not recipients:
+            return []
+        txn_hash = await self.mint_coin(
+            minter, minter.address(), sum(amount for _, amount in recipients), optimistic
+        )
+        await self.wait_for_transaction(txn_hash)
+        return await self.batch_transfer(
+            minter, minter.address(), recipients, chunk_size, on_submit, optimistic
+        )
 
     async def get_balance(
         self,
         coin_address: AccountAddress,
         account_address: AccountAddress,
+        refresh: bool = False,
     ) -> str:
-        """Returns the coin balance of the given account"""
+        """Returns the coin balance of the given account, from the balance cache unless ``refresh`` is set"""
 
+        if not refresh:
+            cached = self.balances.get(str(account_address))
+            if cached != None:
+                return str(cached)
         balance = await self.account_resource(
             account_address,
             f"0x1::coin::CoinStore<{coin_address}::telegage_token::TeleGageToken>",
         )
+        self.balances.set(str(account_address), int(balance["data"]["coin"]["value"]))
         return balance["data"]["coin"]["value"]
 
 
 rest_client = CoinClient(NODE_URL)
 faucet_client = FaucetClient(FAUCET_URL, rest_client)
 admin_wallet = Account.load("admin")
+rest_client.manage_sequence_numbers(admin_wallet, ADMIN_MAX_IN_FLIGHT)
 token_client = AptosTokenClient(rest_client)  # <:!:section_1b
 import base64
 from Crypto.Cipher import AES
@@ -179,6 +1140,119 @@ def decrypt(key, source, decode=True):
     return data[:-padding]  # remove the padding
 
 
+class CachedAccount:
+    __slots__ = ("account", "expires_at")
+
+    def __init__(self, account, expires_at):
+        self.account = account
+        self.expires_at = expires_at
+
+    def clear(self):
+        self.account = None
+        self.expires_at = 0
+
+
+class AccountCache:
+    """Short-lived, size-capped cache of loaded custodial ``Account`` objects.
+
+    Keyed by (user_id, community_id) so repeated actions by an active user skip
+    the decrypt and key parsing. At most ``max_entries`` keys are held; an
+    evicted or invalidated entry is cleared so no reference to the key is left
+    behind in the cache (Python cannot overwrite the SDK's immutable key bytes,
+    they are freed once the last reference goes). ``watch`` drops the accounts
+    of user documents replaced, deleted or given another wallet elsewhere.
+    """
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _drop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry != None:
+            entry.clear()
+            self.evictions += 1
+
+    def get(self, user):
+        """Return the custodial Account of a user document."""
+        key = (str(user.get("user_id")), str(user.get("community_id")))
+        entry = self.entries.get(key)
+        if entry != None and entry.expires_at > time.monotonic():
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry.account
+        self._drop(key)
+        self.misses += 1
+        data = decrypt(str(user.get("user_id")).encode(), user.get("data"))
+        account = Account.load_key(data.decode())
+        self.entries[key] = CachedAccount(account, time.monotonic() + self.ttl)
+        while len(self.entries) > self.max_entries:
+            self._drop(next(iter(self.entries)))
+        return account
+
+    def invalidate(self, user_id, community_id):
+        self._drop((str(user_id), str(community_id)))
+
+    def clear(self):
+        for key in list(self.entries):
+            self._drop(key)
+
+    def _on_user_change(self, change):
+        document = change.get("fullDocument")
+        if document == None:
+            # Deletes only carry the _id, drop everything
+            self.clear()
+            user_cache.invalidate()
+        else:
+            self.invalidate(document.get("user_id"), document.get("community_id"))
+            user_cache.invalidate(document)
+
+    async def watch(self):
+        """Invalidate accounts from a MongoDB change stream on the users until the task is cancelled."""
+        pipeline = [
+            {
+                "$match": {
+                    "$or": [
+                        {"operationType": {"$in": ["replace", "delete"]}},
+                        {"updateDescription.updatedFields.data": {"$exists": True}},
+                        {
+                            "updateDescription.updatedFields.TeleTokens_CustodialAddress": {
+                                "$exists": True
+                            }
+                        },
+                    ]
+                }
+            }
+        ]
+        try:
+            async with await users_collection.watch(
+                pipeline, full_document="updateLookup"
+            ) as stream:
+                async for change in stream:
+                    self._on_user_change(change)
+        except OperationFailure as e:
+            # Change streams need a replica set, fall back to TTL expiry only
+            print(f"Account cache change stream unavailable, relying on TTL: {e}")
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0,
+            "evictions": self.evictions,
+        }
+
+
+account_cache = AccountCache(ACCOUNT_CACHE_TTL, ACCOUNT_CACHE_MAX_ENTRIES)
+
+
 import cloudinary
 import cloudinary.uploader
 import cloudinary.api
@@ -206,10 +1280,17 @@ def upload_to_cloudinary(image_path, public_id):
 def get_database():
 
     # Provide the mongodb atlas url to connect python to mongodb using pymongo
-    CONNECTION_STRING = "<Add mongodb url here>"
+    CONNECTION_STRING = os.getenv("MONGODB_CONNECTION_STRING", "<Add mongodb url here>")
 
-    # Create a connection using MongoClient. You can import MongoClient or use pymongo.MongoClient
-    client = MongoClient(CONNECTION_STRING)
+    # One AsyncMongoClient (and its connection pool) is shared by every handler, so
+    # database round-trips never block the event loop
+    client = AsyncMongoClient(
+        CONNECTION_STRING,
+        maxPoolSize=MONGODB_MAX_POOL_SIZE,
+        minPoolSize=MONGODB_MIN_POOL_SIZE,
+        maxIdleTimeMS=MONGODB_MAX_IDLE_TIME_MS,
+        waitQueueTimeoutMS=MONGODB_WAIT_QUEUE_TIMEOUT_MS,
+    )
 
     # Create the database for our example (we will use the same database throughout the tutorial
     return client["telegram_communities"]
@@ -219,6 +1300,344 @@ dbname = get_database()
 community_collection = dbname["telegram_community"]
 topics_collection = dbname["community_topics"]
 users_collection = dbname["community_users"]
+activity_collection = dbname["community_activity"]
+wallet_pool_collection = dbname["wallet_pool"]
+points_ledger_collection = dbname["points_ledger"]
+
+
+async def ensure_indexes():
+    """Create the indexes behind every hot query. Safe to run on every start."""
+    index_specs = [
+        (community_collection, [("community_id", 1)], {"unique": True}),
+        (community_collection, [("owner_id", 1)], {}),
+        (users_collection, [("user_id", 1), ("community_id", 1)], {"unique": True}),
+        (users_collection, [("wallet_state", 1)], {"sparse": True}),
+        (topics_collection, [("topic_id", 1), ("community_id", 1)], {}),
+        (activity_collection, [("community_id", 1), ("timestamp", -1), ("_id", -1)], {}),
+        (wallet_pool_collection, [("state", 1), ("created_at", 1)], {}),
+        (points_ledger_collection, [("state", 1), ("timestamp", 1)], {}),
+        (points_ledger_collection, [("user_id", 1), ("community_id", 1), ("state", 1)], {}),
+    ]
+    for collection, keys, options in index_specs:
+        try:
+            await collection.create_index(keys, **options)
+        except OperationFailure as e:
+            print(f"Could not create index {keys} on {collection.name}: {e}")
+    if ACTIVITY_TTL_DAYS > 0:
+        ttl_seconds = ACTIVITY_TTL_DAYS * 24 * 60 * 60
+        try:
+            await activity_collection.create_index(
+                "timestamp", expireAfterSeconds=ttl_seconds
+            )
+        except OperationFailure:
+            # The TTL index exists with another expiry, update it in place
+            await dbname.command(
+                "collMod",
+                activity_collection.name,
+                index={"keyPattern": {"timestamp": 1}, "expireAfterSeconds": ttl_seconds},
+            )
+
+
+def plan_stages(plan):
+    """Yield every stage name of an explain() query plan tree."""
+    yield plan.get("stage")
+    for child in [plan.get("inputStage"), *plan.get("inputStages", [])]:
+        if child != None:
+            yield from plan_stages(child)
+
+
+async def check_query_plans():
+    """Explain every hot query and return the ones that fall back to a collection scan."""
+    hot_queries = [
+        ("community by id", community_collection, {"community_id": "0"}, None),
+        ("user by id and community", users_collection, {"user_id": "0", "community_id": "0"}, None),
+        ("user by id", users_collection, {"user_id": "0"}, None),
+        ("topic by id and community", topics_collection, {"topic_id": 1, "community_id": "0"}, None),
+        ("activity page", activity_collection, {"community_id": "0"}, [("timestamp", -1), ("_id", -1)]),
+        ("pooled wallet", wallet_pool_collection, {"state": "ready"}, [("created_at", 1)]),
+        ("pending points", points_ledger_collection, {"user_id": "0", "community_id": "0", "state": "pending"}, None),
+        ("points to settle", points_ledger_collection, {"state": "pending"}, [("timestamp", 1)]),
+    ]
+    failures = []
+    for name, collection, query, sort in hot_queries:
+        cursor = collection.find(query).limit(1)
+        if sort != None:
+            cursor = cursor.sort(sort)
+        explanation = await cursor.explain()
+        stages = list(plan_stages(explanation["queryPlanner"]["winningPlan"]))
+        print(f"{name}: {' <- '.join(stage for stage in stages if stage)}")
+        if "COLLSCAN" in stages:
+            failures.append(name)
+    return failures
+
+
+def activity_entry(community_id, username, message):
+    return {
+        "_id": str(uuid.uuid4()),
+        "community_id": str(community_id),
+        "timestamp": datetime.now(),
+        "username": username,
+        "message": message,
+    }
+
+
+async def record_activity(community_id, username, message):
+    """Append an entry to the community's activity history."""
+    await activity_collection.insert_one(activity_entry(community_id, username, message))
+
+
+class CommunityWrites:
+    """Collects the MongoDB side effects of one token event and applies them together.
+
+    All changes to the community document are merged into a single update and
+    all activity entries into a single insert_many, so an event costs at most
+    one round-trip per collection instead of one per change.
+    """
+
+    def __init__(self, community_id):
+        self.community_id = str(community_id)
+        self.pushes = {}
+        self.activities = []
+
+    def push(self, field, value):
+        self.pushes.setdefault(field, []).append(value)
+
+    def activity(self, username, message):
+        self.activities.append(activity_entry(self.community_id, username, message))
+
+    async def apply(self):
+        if self.pushes:
+            await community_cache.update_one(
+                {"community_id": self.community_id},
+                {"$push": {field: {"$each": values} for field, values in self.pushes.items()}},
+            )
+        if self.activities:
+            await activity_collection.insert_many(self.activities, ordered=False)
+
+
+class DocumentCache:
+    """Read-through TTL/LRU cache in front of one MongoDB collection.
+
+    Only ``find_one`` queries on exactly ``key_fields`` are cached; anything else
+    goes straight to MongoDB. Writes made through the cache invalidate the
+    affected entry, documents changed by other processes expire after ``ttl``.
+    """
+
+    def __init__(self, collection, key_fields, ttl, max_entries, projection=None):
+        self.collection = collection
+        self.key_fields = key_fields
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.projection = projection
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _key(self, query):
+        if set(query) != set(self.key_fields):
+            return None
+        return tuple(query[field] for field in self.key_fields)
+
+    async def find_one(self, query):
+        key = self._key(query)
+        if key == None:
+            return await self.collection.find_one(query, self.projection)
+        entry = self.entries.get(key)
+        if entry != None and entry[0] > time.monotonic():
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[1]
+        self.misses += 1
+        document = await self.collection.find_one(query, self.projection)
+        if document != None:
+            self.entries[key] = (time.monotonic() + self.ttl, document)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        else:
+            self.entries.pop(key, None)
+        return document
+
+    async def update_one(self, query, update, **kwargs):
+        result = await self.collection.update_one(query, update, **kwargs)
+        self.invalidate(query)
+        return result
+
+    async def insert_one(self, document):
+        result = await self.collection.insert_one(document)
+        self.invalidate(document)
+        return result
+
+    def invalidate(self, query=None):
+        """Drop the entry matching the key fields of ``query``, or everything when it is None."""
+        if query == None:
+            self.invalidations += len(self.entries)
+            self.entries.clear()
+            return
+        if all(field in query for field in self.key_fields):
+            key = tuple(query[field] for field in self.key_fields)
+            if self.entries.pop(key, None) != None:
+                self.invalidations += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+class StatsCounters:
+    """Buffers community stats increments in memory and writes them in one batch.
+
+    Increments are flushed every ``flush_interval`` seconds, as soon as
+    ``flush_events`` increments are pending, and on shutdown. Each community gets
+    a single atomic update pipeline that adds the buffered delta server-side,
+    like ``$inc``, but also accepts counters still stored as strings by older
+    documents and rewrites them as integers. A write in progress is not
+    cancelled with ``run``; the shutdown ``flush`` waits for it first.
+    """
+
+    def __init__(self, flush_interval, flush_events):
+        self.flush_interval = flush_interval
+        self.flush_events = flush_events
+        self.pending = {}
+        self.pending_events = 0
+        self.flush_requested = asyncio.Event()
+        self.writing = None
+        self.flushes = 0
+        self.flushed_events = 0
+        self.failed_flushes = 0
+
+    def add(self, community_id, field, amount=1):
+        counters = self.pending.setdefault(str(community_id), {})
+        counters[field] = counters.get(field, 0) + amount
+        self.pending_events += 1
+        if self.pending_events >= self.flush_events:
+            self.flush_requested.set()
+
+    def _merge_back(self, community_id, counters):
+        pending = self.pending.setdefault(community_id, {})
+        for field, amount in counters.items():
+            pending[field] = pending.get(field, 0) + amount
+
+    async def flush(self):
+        if self.writing != None:
+            await asyncio.shield(self.writing)
+        pending = {
+            community_id: {field: amount for field, amount in counters.items() if amount}
+            for community_id, counters in self.pending.items()
+        }
+        pending = {community_id: counters for community_id, counters in pending.items() if counters}
+        events = self.pending_events
+        self.pending = {}
+        self.pending_events = 0
+        if not pending:
+            return
+        # The increments are only in this write now, it must not be cut off midway
+        self.writing = asyncio.ensure_future(self._write(pending, events))
+        try:
+            await asyncio.shield(self.writing)
+        finally:
+            if self.writing.done():
+                self.writing = None
+
+    async def _write(self, pending, events):
+        community_ids = list(pending)
+        requests = [
+            UpdateOne(
+                {"community_id": community_id},
+                [
+                    {
+                        "$set": {
+                            f"stats.{field}": {
+                                "$add": [
+                                    {
+                                        "$convert": {
+                                            "input": f"$stats.{field}",
+                                            "to": "long",
+                                            "onError": 0,
+                                            "onNull": 0,
+                                        }
+                                    },
+                                    amount,
+                                ]
+                            }
+                            for field, amount in pending[community_id].items()
+                        }
+                    }
+                ],
+            )
+            for community_id in community_ids
+        ]
+        try:
+            await community_collection.bulk_write(requests, ordered=False)
+        except BulkWriteError as e:
+            self.failed_flushes += 1
+            print(f"Failed to flush some community stats: {e.details.get('writeErrors')}")
+            for error in e.details.get("writeErrors", []):
+                community_id = community_ids[error["index"]]
+                self._merge_back(community_id, pending[community_id])
+            return
+        except PyMongoError as e:
+            self.failed_flushes += 1
+            print(f"Failed to flush community stats, retrying on next flush: {e}")
+            for community_id, counters in pending.items():
+                self._merge_back(community_id, counters)
+            self.pending_events += events
+            return
+        self.flushes += 1
+        self.flushed_events += events
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.flush_requested.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.flush_requested.clear()
+            await self.flush()
+
+    def stats(self):
+        return {
+            "pending_communities": len(self.pending),
+            "pending_events": self.pending_events,
+            "flushes": self.flushes,
+            "flushed_events": self.flushed_events,
+            "failed_flushes": self.failed_flushes,
+        }
+
+
+stats_counters = StatsCounters(STATS_FLUSH_INTERVAL, STATS_FLUSH_EVENTS)
+
+
+community_cache = DocumentCache(
+    community_collection,
+    ("community_id",),
+    COMMUNITY_CACHE_TTL,
+    DOCUMENT_CACHE_MAX_ENTRIES,
+    # The bot never reads the member list or the stats back, stats are only incremented
+    projection={"users": 0, "stats": 0},
+)
+topic_cache = DocumentCache(
+    topics_collection,
+    ("topic_id", "community_id"),
+    TOPIC_CACHE_TTL,
+    DOCUMENT_CACHE_MAX_ENTRIES,
+)
+user_cache = DocumentCache(
+    users_collection,
+    ("user_id", "community_id"),
+    USER_CACHE_TTL,
+    DOCUMENT_CACHE_MAX_ENTRIES,
+)
 
 
 # :!:>section_6
@@ -248,181 +1667,834 @@ async def get_token_data(
     }  # <:!:get_token_data
 
 
-async def modify_tokens(user_id, community_id, action, amount):
-    """Modify the TeleToken Balance of the User. This is an tool that needs to be used to update a users Token Balance"""
-    user = users_collection.find_one({"user_id": user_id, "community_id": community_id})
-    community = community_collection.find_one({"community_id": community_id})
-    stats = community["stats"]
-    if user == None:
-        user_account = Account.generate()
-        try:
-            await faucet_client.fund_account(user_account.address(), 20_000_000)
-        except:
-            await faucet_client.fund_account(user_account.address(), 20_000_000)
-        updateddata = str(user_account.private_key)
-        print(user_account.account_address)
-        encrypted = encrypt(str(user_id).encode(), updateddata.encode())
-        print(encrypted)
-        result = get_chat_member(bot_token, int(community_id), int(user_id))
-        print(result)
-        user_item = {
-            "_id": str(uuid.uuid4()),
-            "user_id": str(user_id),
-            "user_name": result.get("user", dict()).get("username", "NA"),
-            "name": result.get("user", dict()).get("first_name", "NA"),
-            "TeleTokens_CustodialAddress": str(user_account.account_address),
-            "data": str(encrypted),
-            "community_id": community_id,
+class ActivityDigest:
+    """Posts community activity to its Activities topic as combined digest messages.
+
+    Lines are buffered per community and sent as one message ``interval``
+    seconds after the first buffered line, or once ``max_lines`` are waiting.
+    ``urgent`` lines go out immediately together with whatever is buffered
+    before them, so the topic keeps the order of events.
+    """
+
+    # Telegram rejects longer messages
+    MAX_MESSAGE_CHARS = 4096
+
+    def __init__(self, interval, max_lines):
+        self.interval = interval
+        self.max_lines = max_lines
+        self.buffers = {}
+        self.timers = {}
+        self.locks = {}
+        self.sending = set()
+        self.digests = 0
+        self.lines = 0
+        self.urgent = 0
+        self.errors = 0
+
+    def add(self, community_id, line, urgent=False):
+        community_id = str(community_id)
+        buffer = self.buffers.setdefault(community_id, [])
+        buffer.append(line)
+        if urgent:
+            self.urgent += 1
+        if urgent or self.interval <= 0 or len(buffer) >= self.max_lines:
+            self._flush(community_id)
+        elif community_id not in self.timers:
+            self.timers[community_id] = asyncio.get_running_loop().call_later(
+                self.interval, self._flush, community_id
+            )
+
+    def _flush(self, community_id):
+        timer = self.timers.pop(community_id, None)
+        if timer != None:
+            timer.cancel()
+        lines = self.buffers.pop(community_id, [])
+        if lines:
+            task = asyncio.create_task(self._send(community_id, lines))
+            self.sending.add(task)
+            task.add_done_callback(self.sending.discard)
+
+    def _messages(self, lines):
+        text = ""
+        for line in lines:
+            line = line[: self.MAX_MESSAGE_CHARS]
+            if text and len(text) + 1 + len(line) > self.MAX_MESSAGE_CHARS:
+                yield text
+                text = ""
+            text = f"{text}\n{line}" if text else line
+        if text:
+            yield text
+
+    async def _send(self, community_id, lines):
+        # Digests of one community are sent one after another to keep their order
+        async with self.locks.setdefault(community_id, asyncio.Lock()):
+            try:
+                community = await community_cache.find_one({"community_id": community_id})
+                if community == None:
+                    return
+                thread_id = int(community.get("activities_id", 0))
+                for text in self._messages(lines):
+                    await bot.send_message(int(community_id), text, message_thread_id=thread_id)
+                    self.digests += 1
+                self.lines += len(lines)
+            except Exception as e:
+                self.errors += 1
+                print(f"Sending the activity digest of {community_id} failed: {e}")
+
+    async def flush_all(self):
+        for community_id in list(self.buffers):
+            self._flush(community_id)
+        if self.sending:
+            await asyncio.gather(*self.sending)
+
+    def stats(self):
+        return {
+            "buffered_lines": sum(len(buffer) for buffer in self.buffers.values()),
+            "digests": self.digests,
+            "lines": self.lines,
+            "urgent": self.urgent,
+            "errors": self.errors,
         }
-        txn_hash = await rest_client.register_coin(admin_wallet.address(), user_account)
-        await rest_client.wait_for_transaction(txn_hash)
-        txn_hash = await rest_client.mint_coin(
-            admin_wallet, user_account.address(), 1000
-        )
-        await rest_client.wait_for_transaction(txn_hash)
-        generated_id = users_collection.insert_one(user_item).inserted_id
-        community_collection.update_one(
-            {"community_id": community_id}, {"$push": {"users": generated_id}}
-        )
-        community_collection.update_one(
-        {"community_id": str(community_id)},
-        {
-            "$push": {
-                "stats.actions": {
-                    "timestamp": str(datetime.now()),
-                    "username": str(result.get("user", dict()).get("username", "NA")),
-                    "message": f"{result.get('user', dict()).get('username', 'NA')} has joined the Community",
-                }
-            }
-        },
-        )
-        balance = await rest_client.get_balance(
-            admin_wallet.address(), user_account.address()
-        )
-        print(f"Account for user : initial TeleGage balance: {balance}")
-        if community!=None:
-            thread_id=int(community.get("activities_id",0))
-            await bot.send_message(int(community_id),f"{result.get('user', dict()).get('username', 'NA')} has joined the Community",message_thread_id=thread_id)
-            
-    user = users_collection.find_one({"user_id": user_id, "community_id": community_id})
-    print(user)
-    data = decrypt(str(user_id).encode(), user.get("data"))
-    print(data.decode())
-    my_account = Account.load_key(data.decode())
-    if action.lower() == "deduct":
-        balance = await rest_client.get_balance(
-            admin_wallet.address(), my_account.address()
-        )
-        print(f"{user.get('user_name') }'s updated TeleGage balance: {balance}")
-        new_balance = int(balance) - amount
-        community_collection.update_one(
-            {"community_id": community_id},
+
+
+activity_digest = ActivityDigest(ACTIVITY_DIGEST_INTERVAL, ACTIVITY_DIGEST_MAX_LINES)
+
+
+class WalletPool:
+    """Keeps a stock of funded, coin-registered and seeded wallets for new users.
+
+    Pooled keys are encrypted with ``WALLET_POOL_SECRET``; ``claim`` atomically
+    marks one entry as claimed and re-encrypts its key for the claiming user,
+    so onboarding costs a single MongoDB round trip. Once the user row holds the
+    wallet, ``consume`` deletes the entry so the key is not kept under the pool
+    secret too, and ``release`` returns it if the row was never written.
+    ``run`` refills the pool up to ``target`` whenever fewer than ``low_water``
+    wallets are ready.
+    """
+
+    def __init__(self, low_water, target, concurrency, check_interval, seed_amount):
+        self.low_water = low_water
+        self.target = target
+        self.concurrency = concurrency
+        self.check_interval = check_interval
+        self.seed_amount = seed_amount
+        self.creating = 0
+        self.created = 0
+        self.claims = 0
+        self.misses = 0
+        self.errors = 0
+
+    async def claim(self, user_id, community_id):
+        """Take a ready wallet for the user, returning its address and user-encrypted key, or None if the pool is empty."""
+        if self.target <= 0:
+            return None
+        entry = await wallet_pool_collection.find_one_and_update(
+            {"state": "ready"},
             {
                 "$set": {
-                    "stats.points_earned": str(int(stats.get("points_earned")) - amount)
+                    "state": "claimed",
+                    "claimed_at": datetime.now(),
+                    "claimed_by": {"user_id": str(user_id), "community_id": str(community_id)},
                 }
             },
+            sort=[("created_at", 1)],
+            return_document=ReturnDocument.AFTER,
         )
-        community_collection.update_one(
-            {"community_id": community_id},
-            {
-                "$push": {
-                    "stats.actions": {
-                        "timestamp": str(datetime.now()),
-                        "username": str(user.get("user_name")),
-                        "message": f"{user.get('user_name')} has been deducted {amount} points",
+        if entry == None:
+            self.misses += 1
+            return None
+        self.claims += 1
+        private_key = decrypt(WALLET_POOL_SECRET.encode(), entry["data"]).decode()
+        return entry["address"], str(encrypt(str(user_id).encode(), private_key.encode()))
+
+    async def consume(self, address):
+        """Delete a claimed wallet once its user row is written."""
+        await wallet_pool_collection.delete_one({"address": address, "state": "claimed"})
+
+    async def release(self, address):
+        """Put a claimed wallet that ended up unused back into the pool."""
+        await wallet_pool_collection.update_one(
+            {"address": address, "state": "claimed"},
+            {"$set": {"state": "ready"}, "$unset": {"claimed_at": "", "claimed_by": ""}},
+        )
+        self.claims -= 1
+
+    async def _create_wallet(self, semaphore):
+        async with semaphore:
+            self.creating += 1
+            try:
+                user_account = Account.generate()
+                await faucet_client.fund_account(user_account.address(), 20_000_000)
+                txn_hash = await rest_client.register_coin(admin_wallet.address(), user_account)
+                await rest_client.wait_for_transaction(txn_hash)
+                txn_hash = await rest_client.mint_coin(
+                    admin_wallet, user_account.address(), self.seed_amount
+                )
+                await rest_client.wait_for_transaction(txn_hash)
+                await wallet_pool_collection.insert_one(
+                    {
+                        "_id": str(uuid.uuid4()),
+                        "address": str(user_account.account_address),
+                        "data": str(
+                            encrypt(
+                                WALLET_POOL_SECRET.encode(),
+                                str(user_account.private_key).encode(),
+                            )
+                        ),
+                        "state": "ready",
+                        "created_at": datetime.now(),
                     }
-                }
-            },
+                )
+                self.created += 1
+            except Exception as e:
+                self.errors += 1
+                print(f"Creating a pooled wallet failed: {e}")
+            finally:
+                self.creating -= 1
+
+    async def refill(self):
+        """Top the pool up to its target if it fell below the low-water mark."""
+        ready = await wallet_pool_collection.count_documents({"state": "ready"})
+        if ready >= self.low_water:
+            return
+        semaphore = asyncio.Semaphore(self.concurrency)
+        await asyncio.gather(
+            *[self._create_wallet(semaphore) for _ in range(self.target - ready)]
         )
-        if community!=None:
-            thread_id=int(community.get("activities_id",0))
-            await bot.send_message(int(community_id),f"{user.get('user_name')} has been deducted {amount} points",message_thread_id=thread_id)
-        if new_balance < 0:
-            to_transfer = amount + new_balance
-            txn_hash = await rest_client.transfer_coins(
-                my_account,
-                admin_wallet.address(),
-                f"{admin_wallet.address()}::telegage_token::TeleGageToken",
-                to_transfer,
+
+    async def run(self):
+        if self.target <= 0:
+            return
+        while True:
+            try:
+                await self.refill()
+            except PyMongoError as e:
+                print(f"Checking the wallet pool failed: {e}")
+            await asyncio.sleep(self.check_interval)
+
+    def stats(self):
+        return {
+            "creating": self.creating,
+            "created": self.created,
+            "claims": self.claims,
+            "misses": self.misses,
+            "errors": self.errors,
+        }
+
+
+wallet_pool = WalletPool(
+    WALLET_POOL_LOW_WATER,
+    WALLET_POOL_TARGET,
+    WALLET_POOL_REFILL_CONCURRENCY,
+    WALLET_POOL_CHECK_INTERVAL,
+    WALLET_SEED_AMOUNT,
+)
+
+
+class WalletProvisioner:
+    """Creates custodial wallets for new users on a background job queue.
+
+    ``enqueue`` hands out a wallet from the pool when one is ready. Otherwise it
+    stores the user with a freshly generated, encrypted key and
+    ``wallet_state: "pending"``; workers then fund the account, register the
+    TeleGage coin and seed it, recording each step (``funded``, ``registered``,
+    ``ready``) on the user document so an interrupted job resumes where it
+    stopped. Users created before this state existed count as ready.
+
+    Onboarding is single-flight per (user_id, community_id): concurrent callers
+    in this process share one in-flight ``enqueue``, and the upsert on the
+    unique users index keeps other processes from adding a second wallet.
+    """
+
+    STEPS = ["pending", "funded", "registered", "ready"]
+
+    def __init__(self, workers, max_attempts, seed_amount):
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.seed_amount = seed_amount
+        self.queue = asyncio.Queue()
+        self.jobs = {}
+        self.onboarding = {}
+        self.deduplicated = 0
+        self.in_progress = 0
+        self.completed = 0
+        self.failed = 0
+        self.retries = 0
+
+    async def enqueue(self, user_id, community_id, user_name, name):
+        """Record the user with a pooled wallet, or a new one whose on-chain setup is queued, and return the user document."""
+        key = (str(user_id), str(community_id))
+        task = self.onboarding.get(key)
+        if task == None:
+            task = asyncio.ensure_future(self._onboard(user_id, community_id, user_name, name))
+            self.onboarding[key] = task
+            task.add_done_callback(lambda _: self.onboarding.pop(key, None))
+        else:
+            self.deduplicated += 1
+        # A cancelled caller must not abort the onboarding the others wait on
+        return await asyncio.shield(task)
+
+    async def _onboard(self, user_id, community_id, user_name, name):
+        query = {"user_id": str(user_id), "community_id": str(community_id)}
+        pooled = await wallet_pool.claim(user_id, community_id)
+        if pooled != None:
+            address, encrypted = pooled
+            wallet_state = "ready"
+        else:
+            user_account = Account.generate()
+            address = str(user_account.account_address)
+            encrypted = encrypt(str(user_id).encode(), str(user_account.private_key).encode())
+            wallet_state = "pending"
+        user_item = {
+            "_id": str(uuid.uuid4()),
+            "user_id": str(user_id),
+            "user_name": user_name if user_name != None else "NA",
+            "name": name if name != None else "NA",
+            "TeleTokens_CustodialAddress": address,
+            "data": str(encrypted),
+            "community_id": str(community_id),
+            "wallet_state": wallet_state,
+        }
+        try:
+            result = await user_cache.update_one(
+                query,
+                {"$setOnInsert": {k: v for k, v in user_item.items() if k not in query}},
+                upsert=True,
             )
-            community_collection.update_one(
-                {"community_id": community_id},
-                {"$push": {"stats.users_to_be_kicked_out": {
-                            "timestamp": str(datetime.now()),
-                            "username": str(user.get("user_name")),
-                            "user_id": str(user.get("user_id")),
-                        }}},
+            inserted = result.upserted_id != None
+        except DuplicateKeyError:
+            inserted = False
+        except Exception:
+            if pooled != None:
+                await wallet_pool.release(address)
+            raise
+        if not inserted:
+            # Another process onboarded the user first, keep its wallet
+            self.deduplicated += 1
+            account_cache.invalidate(user_id, community_id)
+            user_cache.invalidate(query)
+            if pooled != None:
+                await wallet_pool.release(address)
+            return await users_collection.find_one(query)
+        if pooled != None:
+            await wallet_pool.consume(address)
+        generated_id = user_item["_id"]
+        writes = CommunityWrites(community_id)
+        writes.push("users", generated_id)
+        writes.activity(str(user_item["user_name"]), f"{user_item['user_name']} has joined the Community")
+        await writes.apply()
+        activity_digest.add(community_id, f"{user_item['user_name']} has joined the Community")
+        if wallet_state == "pending":
+            self._schedule(user_item)
+        return user_item
+
+    def _schedule(self, user):
+        key = (str(user["user_id"]), str(user["community_id"]))
+        future = self.jobs.get(key)
+        if future == None:
+            if user["wallet_state"] == "failed":
+                user["wallet_state"] = user.get("failed_state", "pending")
+            future = asyncio.get_running_loop().create_future()
+            # Nobody may be waiting on the job, do not warn about unretrieved failures
+            future.add_done_callback(lambda f: f.cancelled() or f.exception())
+            self.jobs[key] = future
+            self.queue.put_nowait((user, 1))
+        return future
+
+    async def wait_ready(self, user):
+        """Wait until the user's wallet is funded, registered and seeded."""
+        if user.get("wallet_state", "ready") == "ready":
+            return
+        key = (str(user["user_id"]), str(user["community_id"]))
+        future = self.jobs.get(key)
+        if future == None:
+            # The copy we were given may predate the last finished job, re-check it
+            user = await users_collection.find_one(
+                {"user_id": key[0], "community_id": key[1]}
             )
-            community_collection.update_one(
-                {"community_id": community_id},
+            if user == None:
+                account_cache.invalidate(*key)
+                user_cache.invalidate({"user_id": key[0], "community_id": key[1]})
+                raise LookupError(f"User {key[0]} of community {key[1]} no longer exists")
+            if user.get("wallet_state", "ready") == "ready":
+                return
+            future = self._schedule(user)
+        await asyncio.shield(future)
+
+    async def resume(self, owns=None):
+        """Queue the users whose provisioning did not finish before the last shutdown, only of the communities ``owns`` accepts if given."""
+        async for user in users_collection.find(
+            {"wallet_state": {"$in": ["pending", "funded", "registered", "failed"]}}
+        ):
+            if owns == None or owns(user["community_id"]):
+                self._schedule(user)
+
+    async def watch(self, interval, owns=None):
+        """``resume`` now and every ``interval`` seconds, picking up wallets the backend could not seed."""
+        while True:
+            try:
+                await self.resume(owns)
+            except Exception as e:
+                print(f"Resuming wallet provisioning failed: {e}")
+            await asyncio.sleep(interval)
+
+    async def _set_state(self, user, state, **fields):
+        user["wallet_state"] = state
+        await user_cache.update_one(
+            {"user_id": str(user["user_id"]), "community_id": str(user["community_id"])},
+            {"$set": {"wallet_state": state, **fields}},
+        )
+
+    async def _provision(self, user):
+        user_account = account_cache.get(user)
+        if user["wallet_state"] == "pending":
+            await faucet_client.fund_account(user_account.address(), 20_000_000)
+            await self._set_state(user, "funded")
+        if user["wallet_state"] == "funded":
+            txn_hash = await rest_client.register_coin(admin_wallet.address(), user_account)
+            await rest_client.wait_for_transaction(txn_hash)
+            await self._set_state(user, "registered")
+        if user["wallet_state"] == "registered":
+            txn_hash = await rest_client.mint_coin(
+                admin_wallet, user_account.address(), self.seed_amount
+            )
+            await rest_client.wait_for_transaction(txn_hash)
+            await self._set_state(user, "ready")
+        print(f"Wallet of {user.get('user_name')} is ready: {user_account.address()}")
+
+    async def run_worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            user, attempt = await self.queue.get()
+            key = (str(user["user_id"]), str(user["community_id"]))
+            self.in_progress += 1
+            try:
+                await self._provision(user)
+            except Exception as e:
+                if attempt < self.max_attempts:
+                    self.retries += 1
+                    print(f"Provisioning wallet of {user.get('user_name')} failed at {user['wallet_state']}, retrying: {e}")
+                    loop.call_later(2**attempt, self.queue.put_nowait, (user, attempt + 1))
+                else:
+                    self.failed += 1
+                    print(f"Provisioning wallet of {user.get('user_name')} failed: {e}")
+                    # Waiters must hear about the failure even if it cannot be saved
+                    account_cache.invalidate(*key)
+                    future = self.jobs.pop(key)
+                    future.set_exception(e)
+                    try:
+                        await self._set_state(user, "failed", failed_state=user["wallet_state"])
+                    except Exception as error:
+                        print(f"Saving the failed state of {user.get('user_name')}'s wallet failed: {error}")
+            else:
+                self.completed += 1
+                self.jobs.pop(key).set_result(None)
+            finally:
+                self.in_progress -= 1
+                self.queue.task_done()
+
+    def start(self):
+        return [asyncio.create_task(self.run_worker()) for _ in range(self.workers)]
+
+    def stats(self):
+        return {
+            "queued": self.queue.qsize(),
+            "in_progress": self.in_progress,
+            "waiting_jobs": len(self.jobs),
+            "onboarding": len(self.onboarding),
+            "deduplicated": self.deduplicated,
+            "completed": self.completed,
+            "failed": self.failed,
+            "retries": self.retries,
+        }
+
+
+wallet_provisioner = WalletProvisioner(
+    WALLET_PROVISION_WORKERS, WALLET_PROVISION_MAX_ATTEMPTS, WALLET_SEED_AMOUNT
+)
+
+
+class PointsLedger:
+    """Off-chain record of TeleToken awards and deductions, settled on chain in netted batches.
+
+    ``record`` stores a signed delta in ``points_ledger`` right away and a
+    user's balance is their on-chain balance plus their unsettled deltas.
+    ``settle`` nets the pending deltas per user; positive nets are minted to the
+    admin wallet in one transaction and paid out with batch transfers, negative
+    nets are each one transfer back to the admin wallet.
+    Entries move from ``pending`` to ``submitted`` (with the transaction hash)
+    to ``settled``; submitted entries left by a failed or interrupted run are
+    checked against the chain before they are settled again. Pending entries
+    whose amount does not fit a u64 are marked ``invalid`` and left out, so
+    they cannot fail every batch they land in. Settlement transactions leave
+    the balance cache alone, their deltas are counted here until they are
+    settled, and a user with entries submitted or settled within
+    ``BALANCE_CACHE_TTL`` has their balance read from the node again.
+    """
+
+    def __init__(self, interval, batch_size, concurrency):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.recorded = 0
+        self.settled_entries = 0
+        self.transactions = 0
+        self.failures = 0
+
+    async def record(self, user, amount, reason):
+        await points_ledger_collection.insert_one(
+            {
+                "_id": str(uuid.uuid4()),
+                "user_id": str(user["user_id"]),
+                "community_id": str(user["community_id"]),
+                "amount": amount,
+                "reason": reason,
+                "state": "pending",
+                "timestamp": datetime.now(),
+            }
+        )
+        self.recorded += 1
+
+    async def _totals(self, user):
+        """Sum of the user's deltas that are not on chain yet, and whether any moved on chain recently.
+
+        Settlement does not touch the balance caches, so a balance read before a
+        submitted or lately settled entry may or may not include it.
+        """
+        cursor = await points_ledger_collection.aggregate(
+            [
                 {
-                    "$push": {
-                        "stats.actions": {
-                            "timestamp": str(datetime.now()),
-                            "username": str(user.get("user_name")),
-                            "message": f"{user.get('user_name')} has been marked as a user due for a ban",
-                        }
+                    "$match": {
+                        "user_id": str(user["user_id"]),
+                        "community_id": str(user["community_id"]),
+                        "$or": [
+                            {"state": {"$in": ["pending", "submitted"]}},
+                            {
+                                "state": "settled",
+                                "settled_at": {
+                                    "$gte": datetime.now() - timedelta(seconds=BALANCE_CACHE_TTL)
+                                },
+                            },
+                        ],
                     }
                 },
+                {
+                    "$group": {
+                        "_id": None,
+                        "amount": {
+                            "$sum": {"$cond": [{"$eq": ["$state", "settled"]}, 0, "$amount"]}
+                        },
+                        "moving": {
+                            "$sum": {"$cond": [{"$eq": ["$state", "pending"]}, 0, 1]}
+                        },
+                    }
+                },
+            ]
+        )
+        async for total in cursor:
+            return total["amount"], total["moving"] > 0
+        return 0, False
+
+    async def unsettled(self, user):
+        """Sum of the user's deltas that are not on chain yet."""
+        amount, _ = await self._totals(user)
+        return amount
+
+    async def balance(self, user, account):
+        amount, moving = await self._totals(user)
+        onchain = await rest_client.get_balance(
+            admin_wallet.address(), account.address(), refresh=moving
+        )
+        return int(onchain) + amount
+
+    async def _mark(self, ids, state, txn_hash=None):
+        update = {"$set": {"state": state}}
+        if txn_hash != None:
+            update["$set"]["txn_hash"] = txn_hash
+        if state == "settled":
+            update["$set"]["settled_at"] = datetime.now()
+        if state == "pending":
+            update["$unset"] = {"txn_hash": ""}
+        await points_ledger_collection.update_many({"_id": {"$in": ids}}, update)
+
+    async def _recover_submitted(self):
+        hashes = {}
+        async for entry in points_ledger_collection.find({"state": "submitted"}, {"txn_hash": 1}):
+            hashes.setdefault(entry["txn_hash"], []).append(entry["_id"])
+        for txn_hash, ids in hashes.items():
+            try:
+                txn = await rest_client.transaction_by_hash(txn_hash)
+            except ApiError:
+                # The node never saw it or it expired, settle these entries again
+                txn = None
+            if txn != None and txn.get("type") == "pending_transaction":
+                continue
+            if txn != None and txn.get("success"):
+                await self._mark(ids, "settled")
+                self.settled_entries += len(ids)
+            else:
+                await self._mark(ids, "pending")
+
+    async def _settled_user(self, key, ids):
+        """Return the ready user behind ``key``, or None after dealing with entries that need no transaction."""
+        user = await user_cache.find_one({"user_id": key[0], "community_id": key[1]})
+        if user == None:
+            await self._mark(ids, "settled")
+            self.settled_entries += len(ids)
+            return None
+        if user.get("wallet_state", "ready") != "ready":
+            # Settled once the wallet exists on chain
+            return None
+        return user
+
+    async def _settle_debit(self, key, amount, ids):
+        user = await self._settled_user(key, ids)
+        if user == None:
+            return
+        account = account_cache.get(user)
+        onchain = int(
+            await rest_client.get_balance(admin_wallet.address(), account.address())
+        )
+        # Overdrawn users give back what they have left
+        to_transfer = min(-amount, onchain)
+        if to_transfer <= 0:
+            await self._mark(ids, "settled")
+            self.settled_entries += len(ids)
+            return
+        txn_hash = await rest_client.transfer_coins(
+            account,
+            admin_wallet.address(),
+            f"{admin_wallet.address()}::telegage_token::TeleGageToken",
+            to_transfer,
+            optimistic=False,
+        )
+        self.transactions += 1
+        await self._mark(ids, "submitted", txn_hash)
+        rest_client.confirmations.track(
+            txn_hash, lambda outcome: self._confirmed(ids, outcome)
+        )
+
+    async def _confirmed(self, ids, outcome):
+        if outcome["status"] == "success":
+            await self._mark(ids, "settled")
+            self.settled_entries += len(ids)
+        elif outcome["status"] == "failure":
+            self.failures += 1
+            await self._mark(ids, "pending")
+        # Timed out entries stay submitted and are checked on the next run
+
+    async def _settle_credits(self, credits):
+        """Pay every positive net with one mint to the admin wallet and batched transfers out of it."""
+        payable = []
+        for key, amount, ids in credits:
+            user = await self._settled_user(key, ids)
+            if user != None:
+                address = AccountAddress.from_str(user["TeleTokens_CustodialAddress"])
+                payable.append((address, amount, ids))
+        if not payable:
+            return
+        entry_ids = {str(address): ids for address, _, ids in payable}
+
+        async def submitted(chunk_results):
+            self.transactions += 1
+            for result in chunk_results:
+                await self._mark(entry_ids[result["address"]], "submitted", result["txn_hash"])
+
+        try:
+            results = await rest_client.batch_mint(
+                admin_wallet,
+                [(address, amount) for address, amount, _ in payable],
+                on_submit=submitted,
+                optimistic=False,
             )
-            if community!=None:
-                thread_id=int(community.get("activities_id",0))
-                await bot.send_message(int(community_id),f"{user.get('user_name')} has been marked as a user due for a ban",message_thread_id=thread_id)
-            await rest_client.wait_for_transaction(txn_hash)
-        else:
-            txn_hash = await rest_client.transfer_coins(
-                my_account,
-                admin_wallet.address(),
-                f"{admin_wallet.address()}::telegage_token::TeleGageToken",
-                amount,
+        except Exception as e:
+            self.failures += 1
+            print(f"Minting points for settlement failed: {e}")
+            return
+        for result in results:
+            ids = entry_ids[result["address"]]
+            if result["success"]:
+                await self._mark(ids, "settled")
+                self.settled_entries += len(ids)
+            else:
+                # Submitted chunks are re-checked against the chain on the next run
+                self.failures += 1
+                print(f"Settling points to {result['address']} failed: {result.get('error')}")
+
+    async def settle(self):
+        """Net the pending deltas per user and write them on chain."""
+        await self._recover_submitted()
+        nets = {}
+        invalid = []
+        cursor = (
+            points_ledger_collection.find(
+                {"state": "pending"}, {"user_id": 1, "community_id": 1, "amount": 1}
             )
-            await rest_client.wait_for_transaction(txn_hash)
-    elif action.lower() == "award":
-        txn_hash = await rest_client.mint_coin(
-            admin_wallet, my_account.address(), amount
+            .sort("timestamp", 1)
+            .limit(self.batch_size)
         )
-        community_collection.update_one(
-            {"community_id": community_id},
-            {
-                "$set": {
-                    "stats.points_earned": str(int(stats.get("points_earned")) + amount)
-                }
-            },
+        async for entry in cursor:
+            if type(entry.get("amount")) != int or abs(entry["amount"]) >= 2**64:
+                invalid.append(entry["_id"])
+                continue
+            net = nets.setdefault((entry["user_id"], entry["community_id"]), [0, []])
+            net[0] += entry["amount"]
+            net[1].append(entry["_id"])
+        if invalid:
+            print(f"Dropping {len(invalid)} ledger entries with invalid amounts: {invalid}")
+            await self._mark(invalid, "invalid")
+        zero = [ids for amount, ids in nets.values() if amount == 0]
+        if zero:
+            await self._mark([i for ids in zero for i in ids], "settled")
+            self.settled_entries += sum(len(ids) for ids in zero)
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def settle_debit(key, amount, ids):
+            async with semaphore:
+                try:
+                    await self._settle_debit(key, amount, ids)
+                except Exception as e:
+                    self.failures += 1
+                    print(f"Settling points of {key[0]} in {key[1]} failed: {e}")
+
+        await asyncio.gather(
+            self._settle_credits(
+                [(key, amount, ids) for key, (amount, ids) in nets.items() if amount > 0]
+            ),
+            *[settle_debit(key, amount, ids) for key, (amount, ids) in nets.items() if amount < 0],
         )
-        community_collection.update_one(
-            {"community_id": community_id},
-            {
-                "$push": {
-                    "stats.actions": {
-                        "timestamp": str(datetime.now()),
-                        "username": str(user.get("user_name")),
-                        "message": f"{user.get('user_name')} has been awarded {amount} points",
-                    }
-                }
-            },
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.settle()
+            except Exception as e:
+                print(f"Points settlement failed: {e}")
+
+    def stats(self):
+        return {
+            "recorded": self.recorded,
+            "settled_entries": self.settled_entries,
+            "transactions": self.transactions,
+            "failures": self.failures,
+        }
+
+
+points_ledger = PointsLedger(
+    LEDGER_SETTLE_INTERVAL, LEDGER_SETTLE_BATCH, LEDGER_SETTLE_CONCURRENCY
+)
+
+
+async def modify_tokens(user_id, community_id, action, amount):
+    """Modify the TeleToken Balance of the User. This is an tool that needs to be used to update a users Token Balance"""
+    if isinstance(amount, float) and amount.is_integer():
+        amount = int(amount)
+    if type(amount) != int or not 0 < amount < 2**64:
+        # Settled on chain as a u64, anything else would block the user's entries
+        print(f"Skipping {action} of invalid amount {amount!r} for user {user_id}")
+        return
+    user = await user_cache.find_one({"user_id": user_id, "community_id": community_id})
+    if user == None:
+        member = await bot.get_chat_member(int(community_id), int(user_id))
+        user = await wallet_provisioner.enqueue(
+            user_id, community_id, member.user.username, member.user.first_name
+        )
+    print(user)
+    if action.lower() == "deduct":
+        if user.get("wallet_state", "ready") == "ready":
+            balance = await points_ledger.balance(user, account_cache.get(user))
+        else:
+            # Settlement waits for the wallet, until then it will hold the seed and the unsettled deltas
+            balance = wallet_provisioner.seed_amount + await points_ledger.unsettled(user)
+        print(f"{user.get('user_name') }'s updated TeleGage balance: {balance}")
+        new_balance = balance - amount
+        await points_ledger.record(user, -amount, "deduct")
+        stats_counters.add(community_id, "points_earned", -amount)
+        writes = CommunityWrites(community_id)
+        writes.activity(
+            str(user.get("user_name")),
+            f"{user.get('user_name')} has been deducted {amount} points",
+        )
+        if new_balance < 0:
+            writes.push(
+                "stats.users_to_be_kicked_out",
+                {
+                    "timestamp": str(datetime.now()),
+                    "username": str(user.get("user_name")),
+                    "user_id": str(user.get("user_id")),
+                },
+            )
+            writes.activity(
+                str(user.get("user_name")),
+                f"{user.get('user_name')} has been marked as a user due for a ban",
+            )
+        await writes.apply()
+        activity_digest.add(community_id, f"{user.get('user_name')} has been deducted {amount} points")
+        if new_balance < 0:
+            # Managers should see ban flags right away
+            activity_digest.add(
+                community_id,
+                f"{user.get('user_name')} has been marked as a user due for a ban",
+                urgent=True,
+            )
+    elif action.lower() == "award":
+        await points_ledger.record(user, amount, "award")
+        stats_counters.add(community_id, "points_earned", amount)
+        await record_activity(
+            community_id,
+            str(user.get("user_name")),
+            f"{user.get('user_name')} has been awarded {amount} points",
         )
-        if community!=None:
-            thread_id=int(community.get("activities_id",0))
-            await bot.send_message(int(community_id),f"{user.get('user_name')} has been awarded {amount} points",message_thread_id=thread_id)
-        await rest_client.wait_for_transaction(txn_hash)
+        activity_digest.add(community_id, f"{user.get('user_name')} has been awarded {amount} points")
     return "TeleTokens updated successfully"
 
 
-async def invoke_ai(community_id, topic_id, message, user_id):
-    print(community_id)
-    community = community_collection.find_one({"community_id": str(community_id)})
-    topic = topics_collection.find_one({"topic_id": topic_id})
+MODERATION_TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "modify_tokens",
+            "description": "Modify the TeleToken Balance of the User. This is an tool that needs to be used to update a users Token Balance. Call it once per message that needs an action.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "user_id": {
+                        "type": "string",
+                        "description": "The User ID of the User that made the message",
+                    },
+                    "community_id": {
+                        "type": "string",
+                        "description": "The Community ID of the Community the user made the message.",
+                    },
+                    "message_number": {
+                        "type": "integer",
+                        "description": "The number of the message in the batch this action is for.",
+                    },
+                    "action": {
+                        "type": "string",
+                        "enum": ["deduct", "award"],
+                        "description": "The action to be performed on the user based on the message and rules.",
+                    },
+                    "amount": {
+                        "type": "integer",
+                        "description": "The amount of tokens that needs to be either deducted or awarded. It must always be a positve number",
+                    },
+                },
+                "required": ["user_id", "community_id", "message_number", "action", "amount"],
+            },
+        },
+    }
+]
+
+
+def render_system_prompt(community, topic, community_id):
     community_rules = community.get("community_instructions")
     if topic != None:
         topic_rules = topic.get("topic_instructions")
     else:
         topic_rules = community_rules
-    print(topic_rules)
-    messages = [
-        {
-            "role": "system",
-            "content": f"""
+    return f"""
                         You are a community manager bot for a community called {community.get("community_name")}. 
                         You are assigned the task of making sure that community members follow the overall community rules, Topic Specific Rules.
                         You should provide rewards to the users based on their message and the action that they do/follow.
@@ -435,75 +2507,444 @@ async def invoke_ai(community_id, topic_id, message, user_id):
                         {topic_rules}
                         
                         ### User Interaction
-                        User ID: "{user_id}"
                         Community ID: "{community_id}"
-                        The user will now make a message. Use the tool modify_tokens to punsh or award them.
-            """,
+                        The users will now send a batch of numbered messages, each tagged with the User ID of its author.
+                        Judge every message on its own and call the tool modify_tokens once for each message that should be punished or awarded,
+                        using the User ID of that message. Messages that need no action need no tool call.
+            """
+
+
+def count_tokens(text):
+    if tiktoken == None:
+        # Rough estimate for English text when tiktoken is not installed
+        return len(text) // 4
+    return len(tiktoken.get_encoding("cl100k_base").encode(text))
+
+
+class PromptCache:
+    """Caches the rendered system prompt of every (community, topic) pair.
+
+    Entries expire after ``ttl`` seconds and are dropped as soon as a MongoDB
+    change stream reports that the community or topic rules changed, so edits
+    made by the backend (``/create_telegram_channel``, ``/import_channel``,
+    topic updates) are picked up without a Mongo read on every message.
+    """
+
+    COMMUNITY_FIELDS = ["community_name", "community_instructions"]
+    TOPIC_FIELDS = ["topic_instructions"]
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    async def get(self, community_id, topic_id):
+        key = (str(community_id), topic_id)
+        entry = self.entries.get(key)
+        if entry != None and entry["expires_at"] > time.monotonic():
+            self.hits += 1
+            return entry
+        self.misses += 1
+        community = await community_cache.find_one({"community_id": str(community_id)})
+        if community == None:
+            return None
+        topic = await topic_cache.find_one(
+            {"topic_id": topic_id, "community_id": str(community_id)}
+        )
+        if topic == None:
+            # Topics created before they were scoped to their community, topic ids
+            # repeat across chats so only unscoped ones may match
+            topic = await topics_collection.find_one(
+                {"topic_id": topic_id, "community_id": {"$exists": False}}
+            )
+        prompt = render_system_prompt(community, topic, community_id)
+        entry = {
+            "prompt": prompt,
+            "token_count": count_tokens(prompt),
+            "expires_at": time.monotonic() + self.ttl,
+        }
+        self.entries.pop(key, None)
+        while len(self.entries) >= self.max_entries:
+            self.entries.pop(next(iter(self.entries)))
+        self.entries[key] = entry
+        return entry
+
+    def invalidate(self, community_id=None, topic_id=None):
+        """Drop the entries of a community and/or topic, or everything when neither is given."""
+        if community_id == None and topic_id == None:
+            self.invalidations += len(self.entries)
+            self.entries.clear()
+            return
+        for key in list(self.entries):
+            if (community_id == None or key[0] == str(community_id)) and (
+                topic_id == None or key[1] == topic_id
+            ):
+                self.invalidations += 1
+                del self.entries[key]
+
+    def _on_community_change(self, change):
+        document = change.get("fullDocument")
+        if document == None:
+            self.invalidate()
+            community_cache.invalidate()
+        else:
+            self.invalidate(community_id=document.get("community_id"))
+            community_cache.invalidate(document)
+
+    def _on_topic_change(self, change):
+        document = change.get("fullDocument")
+        if document == None:
+            self.invalidate()
+            topic_cache.invalidate()
+        elif document.get("community_id") == None:
+            self.invalidate(topic_id=document.get("topic_id"))
+            topic_cache.invalidate()
+        else:
+            self.invalidate(
+                community_id=document.get("community_id"), topic_id=document.get("topic_id")
+            )
+            topic_cache.invalidate(document)
+
+    async def _watch_collection(self, collection, fields, on_change):
+        pipeline = [
+            {
+                "$match": {
+                    "$or": [
+                        {"operationType": {"$in": ["insert", "replace", "delete"]}},
+                        *[
+                            {f"updateDescription.updatedFields.{field}": {"$exists": True}}
+                            for field in fields
+                        ],
+                    ]
+                }
+            }
+        ]
+        async with await collection.watch(
+            pipeline, full_document="updateLookup"
+        ) as stream:
+            async for change in stream:
+                on_change(change)
+
+    async def watch(self):
+        """Invalidate entries from MongoDB change streams until the task is cancelled."""
+        try:
+            await asyncio.gather(
+                self._watch_collection(
+                    community_collection, self.COMMUNITY_FIELDS, self._on_community_change
+                ),
+                self._watch_collection(
+                    topics_collection, self.TOPIC_FIELDS, self._on_topic_change
+                ),
+            )
+        except OperationFailure as e:
+            # Change streams need a replica set, fall back to TTL expiry only
+            print(f"Prompt cache change stream unavailable, relying on TTL: {e}")
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0,
+            "invalidations": self.invalidations,
+            "cached_prompt_tokens": sum(
+                entry["token_count"] for entry in self.entries.values()
+            ),
+        }
+
+
+prompt_cache = PromptCache(PROMPT_CACHE_TTL, PROMPT_CACHE_MAX_ENTRIES)
+
+
+async def invoke_ai(community_id, topic_id, batch):
+    """Moderate a batch of (user_id, message) pairs from one community topic in a single completion."""
+    print(community_id)
+    system_prompt = await prompt_cache.get(community_id, topic_id)
+    if system_prompt == None:
+        print(f"Community {community_id} not found, skipping moderation")
+        return
+    batch_text = "\n\n".join(
+        f"""### Message {number}
+                            User ID: {user_id}
+                            {message}"""
+        for number, (user_id, message) in enumerate(batch, start=1)
+    )
+    messages = [
+        {
+            "role": "system",
+            "content": system_prompt["prompt"],
         },
         {
             "role": "user",
-            "content": f""" User ID: {user_id} 
-                            ### message: {message}""",
+            "content": batch_text,
         },
     ]
-    tools = [
-        {
-            "type": "function",
-            "function": {
-                "name": "modify_tokens",
-                "description": "Modify the TeleToken Balance of the User. This is an tool that needs to be used to update a users Token Balance",
-                "parameters": {
-                    "type": "object",
-                    "properties": {
-                        "user_id": {
-                            "type": "string",
-                            "description": "The User ID of the User that made the message",
-                        },
-                        "community_id": {
-                            "type": "string",
-                            "description": "The Community ID of the Community the user made the message.",
-                        },
-                        "action": {
-                            "type": "string",
-                            "enum": ["deduct", "award"],
-                            "description": "The action to be performed on the user based on the message and rules.",
-                        },
-                        "amount": {
-                            "type": "number",
-                            "description": "The amount of tokens that needs to be either deducted or awarded. It must always be a positve number",
-                        },
-                    },
-                    "required": ["user_id", "community_id", "action", "amount"],
-                },
-            },
-        }
-    ]
-    response = client.chat.completions.create(
+    response = await client.chat.completions.create(
         model=deployment_name,
         messages=messages,
-        tools=tools,
+        tools=MODERATION_TOOLS,
     )
     response_message = response.choices[0].message
     print(response_message)
     # Step 2: check if GPT wanted to call a function
     if response_message.tool_calls:
         print(response_message.content)
-        # Step 3: call the function
-        # Note: the JSON response may not always be valid; be sure to handle errors
+        # Step 3: call the function for every tool call, grouped per user so that
+        # one user's token updates are applied in order while users run in parallel
         available_functions = {
             "modify_tokens": modify_tokens,
-        }  # only one function in this example, but you can have multiple
-        function_name = response_message.tool_calls[0].function.name
-        fuction_to_call = available_functions[function_name]
-        function_args = json.loads(response_message.tool_calls[0].function.arguments)
-        function_response = await fuction_to_call(
-            user_id=function_args.get("user_id"),
-            community_id=function_args.get("community_id"),
-            action=function_args.get("action"),
-            amount=function_args.get("amount"),
+        }
+        batch_users = {str(user_id) for user_id, _ in batch}
+        calls_by_user = {}
+        for tool_call in response_message.tool_calls:
+            if tool_call.function.name not in available_functions:
+                continue
+            try:
+                function_args = json.loads(tool_call.function.arguments)
+            except json.JSONDecodeError:
+                print(f"Skipping malformed tool call arguments: {tool_call.function.arguments}")
+                continue
+            user_id = str(function_args.get("user_id"))
+            if user_id not in batch_users:
+                print(f"Skipping tool call for user {user_id} outside of the batch")
+                continue
+            calls_by_user.setdefault(user_id, []).append(
+                (available_functions[tool_call.function.name], function_args)
+            )
+
+        async def apply_calls(user_id, calls):
+            for fuction_to_call, function_args in calls:
+                await fuction_to_call(
+                    user_id=user_id,
+                    community_id=str(community_id),
+                    action=function_args.get("action"),
+                    amount=function_args.get("amount"),
+                )
+
+        await asyncio.gather(
+            *(apply_calls(user_id, calls) for user_id, calls in calls_by_user.items())
         )
 
 
+class ModerationPool:
+    """Bounds concurrent moderation work globally and per community.
+
+    A busy community can only hold ``max_per_community`` slots, so it queues
+    behind itself instead of starving the other communities of the global ones.
+    """
+
+    def __init__(self, max_concurrency, max_per_community):
+        self.max_concurrency = max_concurrency
+        self.max_per_community = max_per_community
+        self.global_slots = asyncio.Semaphore(max_concurrency)
+        self.community_slots = {}
+        self.queued = {}
+        self.in_flight = {}
+
+    @staticmethod
+    def _bump(counter, key, delta):
+        value = counter.get(key, 0) + delta
+        if value:
+            counter[key] = value
+        else:
+            counter.pop(key, None)
+
+    async def run(self, community_id, func, *args, **kwargs):
+        community_id = str(community_id)
+        slots = self.community_slots.get(community_id)
+        if slots == None:
+            slots = asyncio.Semaphore(self.max_per_community)
+            self.community_slots[community_id] = slots
+        self._bump(self.queued, community_id, 1)
+        started = False
+        try:
+            async with slots:
+                async with self.global_slots:
+                    self._bump(self.queued, community_id, -1)
+                    self._bump(self.in_flight, community_id, 1)
+                    started = True
+                    try:
+                        return await func(*args, **kwargs)
+                    finally:
+                        self._bump(self.in_flight, community_id, -1)
+        finally:
+            if not started:
+                self._bump(self.queued, community_id, -1)
+            if community_id not in self.queued and community_id not in self.in_flight:
+                self.community_slots.pop(community_id, None)
+
+    def stats(self):
+        return {
+            "max_concurrency": self.max_concurrency,
+            "max_per_community": self.max_per_community,
+            "queued": sum(self.queued.values()),
+            "in_flight": sum(self.in_flight.values()),
+            "communities": {
+                community_id: {
+                    "queued": self.queued.get(community_id, 0),
+                    "in_flight": self.in_flight.get(community_id, 0),
+                }
+                for community_id in set(self.queued) | set(self.in_flight)
+            },
+        }
+
+
+moderation_pool = ModerationPool(MODERATION_MAX_CONCURRENCY, MODERATION_MAX_PER_COMMUNITY)
+
+
+class ModerationBatcher:
+    """Collects messages per (community, topic) and moderates them in one completion.
+
+    A batch is sent when it reaches ``max_size`` messages or ``window`` seconds
+    after its first message, whichever comes first. Batches of the same
+    (community, topic) run one after another, in the order they were sent, so
+    their token updates apply in message order.
+    """
+
+    def __init__(self, pool, window, max_size):
+        self.pool = pool
+        self.window = window
+        self.max_size = max_size
+        self.pending = {}
+        self.timers = {}
+        self.tasks = set()
+        self.locks = {}
+        self.batches_sent = 0
+        self.messages_sent = 0
+
+    def submit(self, community_id, topic_id, user_id, message_text):
+        """Queue a message for moderation and return a future resolved once its batch ran."""
+        loop = asyncio.get_running_loop()
+        key = (str(community_id), topic_id)
+        future = loop.create_future()
+        batch = self.pending.setdefault(key, [])
+        batch.append((str(user_id), message_text, future))
+        if len(batch) >= self.max_size:
+            self._flush(key)
+        elif key not in self.timers:
+            self.timers[key] = loop.call_later(self.window, self._flush, key)
+        return future
+
+    def _flush(self, key):
+        timer = self.timers.pop(key, None)
+        if timer != None:
+            timer.cancel()
+        batch = self.pending.pop(key, None)
+        if not batch:
+            return
+        self.batches_sent += 1
+        self.messages_sent += len(batch)
+        # Created here, in flush order; asyncio.Lock wakes its waiters first come, first served
+        lock, waiting = self.locks.get(key, (asyncio.Lock(), 0))
+        self.locks[key] = (lock, waiting + 1)
+        task = asyncio.create_task(self._run(key, batch, lock))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _run(self, key, batch, lock):
+        community_id, topic_id = key
+        try:
+            async with lock:
+                await self.pool.run(
+                    community_id,
+                    invoke_ai,
+                    community_id,
+                    topic_id,
+                    [(user_id, message_text) for user_id, message_text, _ in batch],
+                )
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_result(None)
+        finally:
+            lock, waiting = self.locks[key]
+            if waiting > 1:
+                self.locks[key] = (lock, waiting - 1)
+            else:
+                self.locks.pop(key)
+
+    async def flush_all(self):
+        for key in list(self.pending):
+            self._flush(key)
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    def stats(self):
+        return {
+            "pending_batches": len(self.pending),
+            "pending_messages": sum(len(batch) for batch in self.pending.values()),
+            "running_batches": len(self.tasks),
+            "batches_sent": self.batches_sent,
+            "messages_sent": self.messages_sent,
+        }
+
+
+class MessagePrefilter:
+    """Decides locally that a message needs no award or deduction, so it skips the LLM.
+
+    Communities can tune it with a ``prefilter`` field on their document:
+    ``{"allow": [...], "deny": [...]}``. A message equal to an allowlisted phrase
+    is skipped, a message containing a denylisted term always goes to the LLM.
+    """
+
+    def __init__(self, min_chars, min_words):
+        self.min_chars = min_chars
+        self.min_words = min_words
+        self.checked = 0
+        self.skipped = {}
+        self.skipped_tokens = 0
+
+    def _reason(self, community, text):
+        normalized = " ".join(text.lower().split())
+        settings = (community or {}).get("prefilter") or {}
+        if any(term.lower() in normalized for term in settings.get("deny", [])):
+            return None
+        if normalized in {phrase.lower() for phrase in settings.get("allow", [])}:
+            return "allowlisted"
+        if normalized.startswith("/"):
+            return "command"
+        if not any(character.isalnum() for character in normalized):
+            return "emoji_or_punctuation"
+        if len(normalized) < self.min_chars or len(normalized.split()) < self.min_words:
+            return "too_short"
+        return None
+
+    def check(self, community, text):
+        """Return why the message can skip moderation, or None when the LLM should see it."""
+        self.checked += 1
+        reason = self._reason(community, text)
+        if reason != None:
+            self.skipped[reason] = self.skipped.get(reason, 0) + 1
+            self.skipped_tokens += count_tokens(text)
+        return reason
+
+    def stats(self):
+        skipped = sum(self.skipped.values())
+        return {
+            "checked": self.checked,
+            "skipped": skipped,
+            "skip_rate": round(skipped / self.checked, 3) if self.checked else 0,
+            "skipped_by_reason": dict(self.skipped),
+            "skipped_message_tokens": self.skipped_tokens,
+        }
+
+
+message_prefilter = MessagePrefilter(PREFILTER_MIN_CHARS, PREFILTER_MIN_WORDS)
+
+
+moderation_batcher = ModerationBatcher(
+    moderation_pool, MODERATION_BATCH_WINDOW_MS / 1000, MODERATION_BATCH_SIZE
+)
+
+
 def download_file(user_id, number, file_info, prompt, negative_prompt):
     file_url = f"https://api.telegram.org/file/bot{bot_token}/{file_info}"
     response = requests.get(file_url, stream=True)
@@ -547,8 +2988,8 @@ async def redeemption(message):
     markup = ReplyKeyboardMarkup(resize_keyboard=True,one_time_keyboard=True)
     user_id = message.from_user.id
     user_accounts = users_collection.find({"user_id": str(user_id)})
-    for user in user_accounts:
-        community = community_collection.find_one(
+    async for user in user_accounts:
+        community = await community_cache.find_one(
             {"community_id": str(user.get("community_id"))}
         )
         print(user)
@@ -577,55 +3018,13 @@ async def redeemption(message):
 async def new_member_manager(message):
     new_user = message.new_chat_members[0]
     community_id = str(message.chat.id)
-    if users_collection.find_one({"user_id": new_user.id, "community_id": community_id}) == None:
-        user_account = Account.generate()
-        try:
-            await faucet_client.fund_account(user_account.address(), 20_000_000)
-        except:
-            await faucet_client.fund_account(user_account.address(), 20_000_000)
-        updateddata = str(user_account.private_key)
-        print(user_account.account_address)
-        encrypted = encrypt(str(new_user.id).encode(), updateddata.encode())
-        print(encrypted)
-        user_item = {
-            "_id": str(uuid.uuid4()),
-            "user_id": str(new_user.id),
-            "user_name": new_user.username,
-            "name": f"{new_user.first_name if new_user.first_name!=None else '' } {new_user.last_name if new_user.last_name!=None else '' }",
-            "TeleTokens_CustodialAddress": str(user_account.account_address),
-            "data": str(encrypted),
-            "community_id": community_id,
-        }
-        txn_hash = await rest_client.register_coin(admin_wallet.address(), user_account)
-        await rest_client.wait_for_transaction(txn_hash)
-        txn_hash = await rest_client.mint_coin(
-            admin_wallet, user_account.address(), 1000
+    if await user_cache.find_one({"user_id": str(new_user.id), "community_id": community_id}) == None:
+        await wallet_provisioner.enqueue(
+            new_user.id,
+            community_id,
+            new_user.username,
+            f"{new_user.first_name if new_user.first_name!=None else '' } {new_user.last_name if new_user.last_name!=None else '' }",
         )
-        await rest_client.wait_for_transaction(txn_hash)
-        user_id = users_collection.insert_one(user_item).inserted_id
-        community_collection.update_one(
-            {"community_id": community_id}, {"$push": {"users": user_id}}
-        )
-        community_collection.update_one(
-        {"community_id": str(community_id)},
-        {
-            "$push": {
-                "stats.actions": {
-                    "timestamp": str(datetime.now()),
-                    "username": str(new_user.username),
-                    "message": f"{new_user.username} has joined the Community",
-                }
-            }
-        },
-        )
-        community=community_collection.find_one({"community_id": str(community_id)})
-        if community!=None:
-            thread_id=int(community.get("activities_id",0))
-            await bot.send_message(int(community_id),f"{new_user.username} has joined the Community",message_thread_id=thread_id)
-        balance = await rest_client.get_balance(
-            admin_wallet.address(), user_account.address()
-        )
-        print(f"Account for {new_user.username} : initial TeleGage balance: {balance}")
 
 
 @bot.message_handler(func=lambda m: True)
@@ -635,76 +3034,37 @@ async def moderate(message):
     chat_type=message.chat.type
     community_id=message.chat.id
     if chat_type=="supergroup":
-        useronject=users_collection.find_one({"user_id": str(user_id), "community_id": str(community_id)})
+        useronject=await user_cache.find_one({"user_id": str(user_id), "community_id": str(community_id)})
         if useronject==None:
-            user_account = Account.generate()
-            try:
-                await faucet_client.fund_account(user_account.address(), 20_000_000)
-            except:
-                await faucet_client.fund_account(user_account.address(), 20_000_000)
-            updateddata = str(user_account.private_key)
-            print(user_account.account_address)
-            encrypted = encrypt(str(user_id).encode(), updateddata.encode())
-            print(encrypted)
-            result = get_chat_member(bot_token, int(community_id), int(user_id))
-            print(result)
-            user_item = {
-                "_id": str(uuid.uuid4()),
-                "user_id": str(user_id),
-                "user_name": result.get("user", dict()).get("username", "NA"),
-                "name": result.get("user", dict()).get("first_name", "NA"),
-                "TeleTokens_CustodialAddress": str(user_account.account_address),
-                "data": str(encrypted),
-                "community_id": community_id,
-            }
-            txn_hash = await rest_client.register_coin(admin_wallet.address(), user_account)
-            await rest_client.wait_for_transaction(txn_hash)
-            txn_hash = await rest_client.mint_coin(
-                admin_wallet, user_account.address(), 1000
-            )
-            await rest_client.wait_for_transaction(txn_hash)
-            generated_id = users_collection.insert_one(user_item).inserted_id
-            community_collection.update_one(
-                {"community_id": community_id}, {"$push": {"users": generated_id}}
-            )
-            community_collection.update_one(
-            {"community_id": str(community_id)},
-            {
-                "$push": {
-                    "stats.actions": {
-                        "timestamp": str(datetime.now()),
-                        "username": str(result.get("user", dict()).get("username", "NA")),
-                        "message": f"{result.get('user', dict()).get('username', 'NA')} has joined the Community",
-                    }
-                }
-            },
-            )
-            balance = await rest_client.get_balance(
-                admin_wallet.address(), user_account.address()
+            # Only queue the wallet setup, moderation goes on while it runs
+            await wallet_provisioner.enqueue(
+                user_id,
+                community_id,
+                message.from_user.username,
+                message.from_user.first_name,
             )
-            print(f"Account for user : initial TeleGage balance: {balance}")
-            community=community_collection.find_one({"community_id": str(community_id)})
-            if community!=None:
-                thread_id=int(community.get("activities_id",0))
-                await bot.send_message(int(community_id),f"{result.get('user', dict()).get('username', 'NA')} has joined the Community",message_thread_id=thread_id)
         user=await bot.get_chat_member(message.chat.id, user_id)
         if user.status!="creator":
             group_name = message.json.get("chat", {}).get("title", "Your Community")
             channel_id = message.json.get("chat", {}).get("id", "None")
             message_text = message.json.get("text", "None")
-            community = community_collection.find_one({"community_id": str(channel_id)})
+            community = await community_cache.find_one({"community_id": str(channel_id)})
             # print(community)
-            current_message_count = int(community["stats"]["number_of_messages"])
-            new_message_count = current_message_count + 1
-            print(new_message_count)
-            community_collection.update_one(
-                {"community_id": str(channel_id)},
-                {"$set": {"stats.number_of_messages": str(new_message_count)}},
-            )
+            stats_counters.add(channel_id, "number_of_messages")
             topic_id = 1
             if message.json.get("is_topic_message", False):
                 topic_id = message.json.get("reply_to_message", {}).get("message_thread_id", 0)
-            await invoke_ai(channel_id, topic_id, message_text, user_id)
+            skip_reason = message_prefilter.check(community, message_text)
+            if skip_reason != None:
+                print(f"Skipping moderation of message from {user_id}: {skip_reason}")
+                return
+            # Only queue the message: the lane moves on while the batch is moderated
+            moderation = moderation_batcher.submit(channel_id, topic_id, user_id, message_text)
+            moderation.add_done_callback(
+                lambda done: done.cancelled()
+                or done.exception() == None
+                or print(f"Moderating message from {user_id} failed: {done.exception()}")
+            )
 
 
 @bot.message_handler(content_types=["web_app_data"])
@@ -719,11 +3079,9 @@ async def web_app_data_manager(message):
     if jsonObject["action"] == "Add Sticker":
         pics = await bot.get_user_profile_photos(user_id)
         print(pics)
-        user = users_collection.find_one({"user_id": str(user_id)})
+        user = await users_collection.find_one({"user_id": str(user_id)})
         if user != None:
-            data = decrypt(str(user_id).encode(), user.get("data"))
-            print(data.decode())
-            my_account = Account.load_key(data.decode())
+            my_account = account_cache.get(user)
             balance = await rest_client.get_balance(
                 admin_wallet.address(), my_account.address()
             )
@@ -820,28 +3178,15 @@ async def web_app_data_manager(message):
                 print(minted_tokens)
                 community_id=str(jsonObject["community_id"])
                 print(community_id)
-                community = community_collection.find_one(
+                community = await community_cache.find_one(
                     {"community_id": community_id}
                 )
                 print(community)
-                current_message_count = int(community["stats"]["number_of_nfts_minted"])
-                new_message_count = current_message_count + 1
-                print(new_message_count)
-                community_collection.update_one(
-                    {"community_id": str(community["community_id"])},
-                    {"$set": {"stats.number_of_nfts_minted": str(new_message_count)}},
-                )
-                community_collection.update_one(
-                    {"community_id": str(community["community_id"])},
-                    {
-                        "$push": {
-                            "stats.actions": {
-                                "timestamp": str(datetime.now()),
-                                "username": str(user.get("user_name")),
-                                "message": f"{user.get('user_name')} has Minted an NFT",
-                            }
-                        }
-                    },
+                stats_counters.add(community["community_id"], "number_of_nfts_minted")
+                await record_activity(
+                    str(community["community_id"]),
+                    str(user.get("user_name")),
+                    f"{user.get('user_name')} has Minted an NFT",
                 )
                 # collection_data = await get_collection_data(token_client, collection_addr)
                 # print(collection_data)
@@ -871,33 +3216,14 @@ async def web_app_data_manager(message):
                         txn_hash
                     )
                     print(minted_tokens)
-                    community = community_collection.find_one(
+                    community = await community_cache.find_one(
                         {"community_id": str(jsonObject["community_id"])}
                     )
-                    current_message_count = int(
-                        community["stats"]["number_of_nfts_minted"]
-                    )
-                    new_message_count = current_message_count + 1
-                    print(new_message_count)
-                    community_collection.update_one(
-                        {"community_id": str(community["community_id"])},
-                        {
-                            "$set": {
-                                "stats.number_of_nfts_minted": str(new_message_count)
-                            }
-                        },
-                    )
-                    community_collection.update_one(
-                        {"community_id": str(community["community_id"])},
-                        {
-                            "$push": {
-                                "stats.actions": {
-                                    "timestamp": str(datetime.now()),
-                                    "username": str(user.get("user_name")),
-                                    "message": f"{user.get('user_name')} has Minted an NFT",
-                                }
-                            }
-                        },
+                    stats_counters.add(community["community_id"], "number_of_nfts_minted")
+                    await record_activity(
+                        str(community["community_id"]),
+                        str(user.get("user_name")),
+                        f"{user.get('user_name')} has Minted an NFT",
                     )
                     await bot.add_sticker_to_set(
                         user_id,
@@ -939,11 +3265,9 @@ async def mintnft(message):
     if jsonObject["action"] == "Add Sticker":
         pics = await bot.get_user_profile_photos(user_id)
         print(pics)
-        user = users_collection.find_one({"user_id": str(user_id)})
+        user = await users_collection.find_one({"user_id": str(user_id)})
         if user != None:
-            data = decrypt(str(user_id).encode(), user.get("data"))
-            print(data.decode())
-            my_account = Account.load_key(data.decode())
+            my_account = account_cache.get(user)
             balance = await rest_client.get_balance(
                 admin_wallet.address(), my_account.address()
             )
@@ -1040,28 +3364,15 @@ async def mintnft(message):
                 print(minted_tokens)
                 community_id=str(jsonObject["community_id"])
                 print(community_id)
-                community = community_collection.find_one(
+                community = await community_cache.find_one(
                     {"community_id": community_id}
                 )
                 print(community)
-                current_message_count = int(community["stats"]["number_of_nfts_minted"])
-                new_message_count = current_message_count + 1
-                print(new_message_count)
-                community_collection.update_one(
-                    {"community_id": str(community["community_id"])},
-                    {"$set": {"stats.number_of_nfts_minted": str(new_message_count)}},
-                )
-                community_collection.update_one(
-                    {"community_id": str(community["community_id"])},
-                    {
-                        "$push": {
-                            "stats.actions": {
-                                "timestamp": str(datetime.now()),
-                                "username": str(user.get("user_name")),
-                                "message": f"{user.get('user_name')} has Minted an NFT",
-                            }
-                        }
-                    },
+                stats_counters.add(community["community_id"], "number_of_nfts_minted")
+                await record_activity(
+                    str(community["community_id"]),
+                    str(user.get("user_name")),
+                    f"{user.get('user_name')} has Minted an NFT",
                 )
                 # collection_data = await get_collection_data(token_client, collection_addr)
                 # print(collection_data)
@@ -1091,33 +3402,14 @@ async def mintnft(message):
                         txn_hash
                     )
                     print(minted_tokens)
-                    community = community_collection.find_one(
+                    community = await community_cache.find_one(
                         {"community_id": str(jsonObject["community_id"])}
                     )
-                    current_message_count = int(
-                        community["stats"]["number_of_nfts_minted"]
-                    )
-                    new_message_count = current_message_count + 1
-                    print(new_message_count)
-                    community_collection.update_one(
-                        {"community_id": str(community["community_id"])},
-                        {
-                            "$set": {
-                                "stats.number_of_nfts_minted": str(new_message_count)
-                            }
-                        },
-                    )
-                    community_collection.update_one(
-                        {"community_id": str(community["community_id"])},
-                        {
-                            "$push": {
-                                "stats.actions": {
-                                    "timestamp": str(datetime.now()),
-                                    "username": str(user.get("user_name")),
-                                    "message": f"{user.get('user_name')} has Minted an NFT",
-                                }
-                            }
-                        },
+                    stats_counters.add(community["community_id"], "number_of_nfts_minted")
+                    await record_activity(
+                        str(community["community_id"]),
+                        str(user.get("user_name")),
+                        f"{user.get('user_name')} has Minted an NFT",
                     )
                     await bot.add_sticker_to_set(
                         user_id,
@@ -1163,4 +3455,382 @@ def chat_m(message: types.ChatMemberUpdated):
         )  # Welcome message
 
 
-asyncio.run(bot.polling(skip_pending=True))
\ No newline at end of file
+def bot_stats():
+    return {
+        "moderation": moderation_pool.stats(),
+        "batching": moderation_batcher.stats(),
+        "prefilter": message_prefilter.stats(),
+        "prompt_cache": prompt_cache.stats(),
+        "community_cache": community_cache.stats(),
+        "topic_cache": topic_cache.stats(),
+        "user_cache": user_cache.stats(),
+        "stats_counters": stats_counters.stats(),
+        "account_cache": account_cache.stats(),
+        "wallet_provisioning": wallet_provisioner.stats(),
+        "wallet_pool": wallet_pool.stats(),
+        "points_ledger": points_ledger.stats(),
+        "sequence_numbers": rest_client.sequence_stats(),
+        "confirmations": rest_client.confirmations.stats(),
+        "balances": rest_client.balances.stats(),
+        "activity_digest": activity_digest.stats(),
+        "outbox": outbox.stats(),
+        "dispatcher": bot.dispatcher.stats(),
+    }
+
+
+async def report_stats(label=""):
+    while True:
+        await asyncio.sleep(STATS_REPORT_INTERVAL)
+        print(f"Bot stats{label}: {json.dumps(bot_stats())}")
+
+
+async def serve_webhook(forward=None):
+    """Receive updates over a webhook instead of long polling until SIGINT or SIGTERM.
+
+    Each request is checked against ``WEBHOOK_SECRET``, acknowledged right away
+    and its update handed to the bot's dispatcher in the background, or to
+    ``forward`` as Telegram sent it. On shutdown the server stops accepting
+    requests and the updates already received get ``WEBHOOK_DRAIN_TIMEOUT``
+    seconds to reach the dispatcher, which ``main`` then drains.
+    """
+    in_flight = set()
+
+    async def receive(request):
+        secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(secret.encode(), WEBHOOK_SECRET.encode()):
+            return web.Response(status=403)
+        try:
+            payload = json.loads(await request.text())
+            if not isinstance(payload, dict) or not isinstance(payload.get("update_id"), int):
+                raise ValueError("Not a Telegram update")
+            if forward != None:
+                forward(payload)
+                return web.Response()
+            update = types.Update.de_json(payload)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            # A malformed update is the sender's error, not a server failure
+            return web.Response(status=400)
+        task = asyncio.create_task(bot.process_new_updates([update]))
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, receive)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    await bot.set_webhook(
+        url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        drop_pending_updates=True,
+    )
+    print(f"Receiving updates on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+        if in_flight:
+            print(f"Draining {len(in_flight)} updates")
+            await asyncio.wait(in_flight, timeout=WEBHOOK_DRAIN_TIMEOUT)
+
+
+async def poll_raw_updates(forward):
+    """Long poll Telegram and pass every update, as Telegram sent it, to ``forward`` until SIGINT or SIGTERM."""
+    await bot.delete_webhook()
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    # Skip what arrived while the bot was down, like polling(skip_pending=True)
+    pending = await asyncio_helper.get_updates(bot_token, offset=-1, limit=1, timeout=0)
+    offset = pending[-1]["update_id"] + 1 if pending else None
+    stopped = asyncio.create_task(stop.wait())
+    while not stop.is_set():
+        poll = asyncio.create_task(
+            asyncio_helper.get_updates(
+                bot_token, offset=offset, limit=100, timeout=20, request_timeout=25
+            )
+        )
+        await asyncio.wait([poll, stopped], return_when=asyncio.FIRST_COMPLETED)
+        if not poll.done():
+            poll.cancel()
+            break
+        try:
+            updates = poll.result()
+        except Exception as e:
+            print(f"Getting updates failed: {e}")
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            offset = update["update_id"] + 1
+            forward(update)
+
+
+def shard_of(chat_id, count):
+    """Index of the shard owning ``chat_id``: its crc32 falls in that shard's 1/``count`` of the hash range."""
+    return (zlib.crc32(str(chat_id).encode()) * count) >> 32
+
+
+def raw_update_chat_id(update):
+    """Chat id of an update as Telegram sent it, or the sender's id for updates without a chat."""
+    for name in UpdateDispatcher.EVENTS:
+        event = update.get(name)
+        if event != None:
+            return event["chat"]["id"]
+    callback = update.get("callback_query")
+    if callback != None and callback.get("message") != None:
+        return callback["message"]["chat"]["id"]
+    for event in update.values():
+        if isinstance(event, dict) and "from" in event:
+            return event["from"]["id"]
+    return update.get("update_id", 0)
+
+
+async def consume_inbox(inbox):
+    """Handle the updates the supervisor forwards until it sends None."""
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            raw = await loop.run_in_executor(None, inbox.get, True, 1)
+        except Empty:
+            continue
+        if raw == None:
+            return
+        await bot.process_new_updates([types.Update.de_json(raw)])
+
+
+def run_shard(index, count, inbox, signer):
+    # The supervisor handles Ctrl+C and stops the shards through their queues
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(main(shard=(index, count), inbox=inbox, signer=signer))
+
+
+async def serve_signing(requests, shards):
+    """Sign and submit the admin transactions the shards send, all with this process's admin sequence numbers."""
+    loop = asyncio.get_running_loop()
+    pending = set()
+
+    async def sign(index, request_id, payload):
+        try:
+            signed_transaction = await rest_client.create_bcs_signed_transaction(
+                admin_wallet, TransactionPayload.deserialize(Deserializer(payload))
+            )
+            reply = (request_id, await rest_client.submit_bcs_transaction(signed_transaction), None)
+        except Exception as e:
+            reply = (request_id, None, str(e))
+        shards[index].replies.put(reply)
+
+    while True:
+        try:
+            index, request_id, payload = await loop.run_in_executor(None, requests.get, True, 1)
+        except Empty:
+            continue
+        task = asyncio.create_task(sign(index, request_id, payload))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+
+
+class Shard:
+    """Worker process handling the updates of the communities whose ids hash into its range.
+
+    The queue outlives the process, so a shard restarted by ``check`` picks up
+    the updates forwarded while it was down and the other shards never notice.
+    Its admin transactions go to the supervisor on the shared ``signing``
+    queue and the answers come back on ``replies``.
+    """
+
+    def __init__(self, context, index, count, signing):
+        self.context = context
+        self.index = index
+        self.count = count
+        self.queue = context.Queue()
+        self.signing = signing
+        self.replies = context.Queue()
+        self.process = None
+        self.forwarded = 0
+        self.restarts = 0
+
+    def start(self):
+        self.process = self.context.Process(
+            target=run_shard,
+            args=(self.index, self.count, self.queue, (self.signing, self.replies)),
+            name=f"telegage-shard-{self.index}",
+        )
+        self.process.start()
+
+    def forward(self, raw):
+        self.forwarded += 1
+        self.queue.put(raw)
+
+    def check(self):
+        if self.process.is_alive():
+            return
+        print(f"Shard {self.index} exited with code {self.process.exitcode}, restarting it")
+        self.restarts += 1
+        self.start()
+
+    def stop(self):
+        self.queue.put(None)
+
+    def join(self, timeout):
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+
+    def stats(self):
+        try:
+            queue_depth = self.queue.qsize()
+        except NotImplementedError:
+            # Not available on macOS
+            queue_depth = None
+        return {
+            "alive": self.process.is_alive(),
+            "pid": self.process.pid,
+            "queue_depth": queue_depth,
+            "forwarded": self.forwarded,
+            "restarts": self.restarts,
+        }
+
+
+async def monitor_shards(shards):
+    last_report = time.monotonic()
+    while True:
+        await asyncio.sleep(SHARD_HEALTH_INTERVAL)
+        for shard in shards:
+            shard.check()
+        if STATS_REPORT_INTERVAL > 0 and time.monotonic() - last_report >= STATS_REPORT_INTERVAL:
+            last_report = time.monotonic()
+            print(f"Shard stats: {json.dumps({shard.index: shard.stats() for shard in shards})}")
+            print(f"Admin sequence numbers: {json.dumps(rest_client.sequence_stats())}")
+
+
+async def supervise(count, webhook=False):
+    """Run ``count`` shard processes and feed them the updates received here, each to the shard owning its chat."""
+    context = multiprocessing.get_context("spawn")
+    signing = context.Queue()
+    shards = [Shard(context, index, count, signing) for index in range(count)]
+    for shard in shards:
+        shard.start()
+    # The only process signing with the admin wallet, shards included
+    signer = asyncio.create_task(serve_signing(signing, shards))
+
+    def forward(update):
+        shards[shard_of(raw_update_chat_id(update), count)].forward(json.dumps(update))
+
+    monitor = asyncio.create_task(monitor_shards(shards))
+    try:
+        if webhook:
+            await serve_webhook(forward)
+        else:
+            await poll_raw_updates(forward)
+    finally:
+        monitor.cancel()
+        for shard in shards:
+            shard.stop()
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(
+            *[
+                loop.run_in_executor(None, shard.join, UPDATE_DRAIN_TIMEOUT + 30)
+                for shard in shards
+            ]
+        )
+        # Shards may sign until they exit
+        signer.cancel()
+
+
+async def main(webhook=False, shard=None, inbox=None, signer=None):
+    """Run the bot. As a shard, ``shard`` is ``(index, count)``, updates come through ``inbox`` and the supervisor signs admin transactions sent on the ``signer`` queues."""
+    await ensure_indexes()
+    background_tasks = [
+        asyncio.create_task(prompt_cache.watch()),
+        asyncio.create_task(account_cache.watch()),
+        asyncio.create_task(stats_counters.run()),
+        *wallet_provisioner.start(),
+    ]
+    if shard == None or shard[0] == 0:
+        # One pool refill and one settlement run for the whole deployment
+        background_tasks.append(asyncio.create_task(wallet_pool.run()))
+        background_tasks.append(asyncio.create_task(points_ledger.run()))
+    if shard != None:
+        remote_signer = RemoteSigner(shard[0], *signer)
+        rest_client.delegate_signer(admin_wallet, remote_signer)
+        background_tasks.append(asyncio.create_task(remote_signer.run()))
+        # Shards share Telegram's overall send limit
+        outbox.global_bucket = TokenBucket(
+            TELEGRAM_GLOBAL_RATE / shard[1], TELEGRAM_GLOBAL_RATE / shard[1]
+        )
+        background_tasks.append(
+            asyncio.create_task(
+                wallet_provisioner.watch(
+                    WALLET_RESUME_INTERVAL,
+                    lambda community_id: shard_of(community_id, shard[1]) == shard[0],
+                )
+            )
+        )
+    else:
+        background_tasks.append(
+            asyncio.create_task(wallet_provisioner.watch(WALLET_RESUME_INTERVAL))
+        )
+    if STATS_REPORT_INTERVAL > 0:
+        label = f" (shard {shard[0]})" if shard != None else ""
+        background_tasks.append(asyncio.create_task(report_stats(label)))
+    try:
+        if inbox != None:
+            await consume_inbox(inbox)
+        elif webhook:
+            await serve_webhook()
+        else:
+            # A webhook left by an earlier --webhook run would make getUpdates fail
+            await bot.delete_webhook()
+            await bot.polling(skip_pending=True)
+    finally:
+        await bot.dispatcher.drain(UPDATE_DRAIN_TIMEOUT)
+        # Moderation may still need the provisioning workers, stop them only after it is done
+        await moderation_batcher.flush_all()
+        await activity_digest.flush_all()
+        for task in background_tasks:
+            task.cancel()
+        await stats_counters.flush()
+        account_cache.clear()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="TeleGage community bot")
+    parser.add_argument(
+        "--check-indexes",
+        action="store_true",
+        help="create the indexes, explain the hot queries and exit non-zero if any of them scans a whole collection",
+    )
+    parser.add_argument(
+        "--webhook",
+        action="store_true",
+        help="receive updates on a webhook server (WEBHOOK_* settings) instead of long polling",
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=0,
+        help="run this many worker processes, each handling the communities whose ids hash into its range, fed by this process",
+    )
+    args = parser.parse_args()
+    if args.check_indexes:
+
+        async def check_indexes():
+            await ensure_indexes()
+            return await check_query_plans()
+
+        failures = asyncio.run(check_indexes())
+        if failures:
+            print(f"Queries without an index: {', '.join(failures)}")
+            sys.exit(1)
+        print("All hot queries use an index")
+    elif args.shards > 0:
+        asyncio.run(supervise(args.shards, webhook=args.webhook))
+    else:
+        asyncio.run(main(webhook=args.webhook))
\ No newline at end of file